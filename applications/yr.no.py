@@ -1,86 +1,198 @@
-from yr.libyr import Yr
-from lib.portipc40 import ThermalPrinter
-import json 
-from pprint import pprint
-from datetime import datetime
-import math
-from time import sleep
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+	Weather receipt from yr.no for the PORTI-PC40.
+
+	The forecast is fetched at most once per REFRESH seconds (conditional GET,
+	an unchanged forecast costs a 304) and the receipt body is rendered to
+	printer bytes as soon as new data arrives, then kept in CACHE_FILE with the
+	HTTP validators. Printing only adds the date header, and the printer reset
+	runs in the background while the cache is checked.
 
+		python applications/yr.no.py          # refresh if stale, then print
+		python applications/yr.no.py --watch  # keep the cache fresh, print nothing
 
+	YR_FORECAST_URL points the fetch somewhere else, e.g. a local stand-in
+	serving a saved forecast.xml; YR_CACHE and YR_REFRESH override the cache
+	file and the refresh period.
+"""
+
+from lib.portipc40 import ThermalPrinter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError, URLError
+from base64 import b64encode, b64decode
+from datetime import datetime
+from time import time, sleep
+from io import BytesIO
+from xml.parsers.expat import ExpatError
+import xmltodict
+import json
+import sys
+import os
 
-p = ThermalPrinter()
-p.rf()
-# p.linefeed()
 
 
 location = "Montenegro/Other/Sveti_Spas~3339206"
 location_xyz=(18.856194, 42.304875, 280)
 
+FORECAST_URL = os.environ.get('YR_FORECAST_URL', "https://www.yr.no/place/%s/forecast.xml" % location)
+# FORECAST_URL = "https://www.yr.no/place/%s/forecast_hour_by_hour.xml" % location
+CACHE_FILE = os.environ.get('YR_CACHE', os.path.expanduser("~/.cache/yr.no.json"))
+REFRESH = int(os.environ.get('YR_REFRESH', 3600))
+TIMEOUT = 10
+
 
-weather = Yr(location_name=location)
-# weather = Yr(location_name=location, forecast_link='forecast_hour_by_hour')
-forecast = weather.dictionary.get('weatherdata', {}).get('forecast', {}).get('tabular',{}).get('time',[])
+def load_cache():
+	try:
+		with open(CACHE_FILE) as f:
+			cache = json.load(f)
+	except (OSError, ValueError):
+		return {}
 
+	# forecast for another place
+	if cache.get('url') != FORECAST_URL:
+		return {}
+	return cache
 
-if forecast:
-	soon = forecast[0] 
+
+def save_cache(cache):
+	os.makedirs(os.path.dirname(CACHE_FILE) or '.', exist_ok=True)
+	tmp = CACHE_FILE + '.tmp'
+	with open(tmp, 'w') as f:
+		json.dump(cache, f)
+	# readers never see a half written file
+	os.replace(tmp, CACHE_FILE)
+
+
+def kmh(mps):
+	return ('%.1f' % (float(mps) * 3.6)).rstrip('0').rstrip('.')
+
+
+def render_body(forecast):
+	""" Receipt body as printer bytes, everything below the date header. """
+	p = ThermalPrinter(printer=BytesIO())
+
+	soon = forecast[0]
 
 	p.justify('c')
 	p.bold()
-	p.size(1, 1)
-	p.print(datetime.now().strftime("%-d %B %Y"))
-	p.print(datetime.now().strftime("%H:%M"))
-	p.linefeed()
 	p.size(2,2)
 	p.print(soon.get('temperature', {}).get('@value')+chr(31)+"/ "+soon.get('precipitation', {}).get('@value')+"mm")
 	p.bold(False)
 	p.size(1,2)
-	p.print(soon.get('windSpeed', {}).get('@name') + " " + ('%.1f' % (float(soon.get('windSpeed', {}).get('@mps')) * 3.6)).rstrip('0').rstrip('.') +"km/h, "+ soon.get('windDirection', {}).get('@code') )
+	p.print(soon.get('windSpeed', {}).get('@name') + " " + kmh(soon.get('windSpeed', {}).get('@mps')) +"km/h, "+ soon.get('windDirection', {}).get('@code') )
 
 	p.linefeed()
 
 	p.rf()
-	for x in range(1, 5):
-		fc = forecast[x]
-		t_from = datetime.strptime(fc.get('@from'), '%Y-%m-%dT%H:%M:%S').strftime("%H")
-		t_to = datetime.strptime(fc.get('@to'), '%Y-%m-%dT%H:%M:%S').strftime("%H")
+	for fc in forecast[1:5]:
+		# '2020-09-02T18:00:00', the hour is all we print
+		t_from = fc.get('@from')[11:13]
+		t_to = fc.get('@to')[11:13]
 
-		
 		fc_str = "%s-%s:  %s, %skm/h %s,%smm" % (
 					t_from,
 					t_to,
 					fc.get('temperature', {}).get('@value')+chr(31),
-					('%.1f' % (float(fc.get('windSpeed',     {}).get('@mps')) * 3.6)).rstrip('0').rstrip('.').rjust(4),
+					kmh(fc.get('windSpeed', {}).get('@mps')).rjust(4),
 					fc.get('windDirection', {}).get('@code').rjust(3),
 					('%.1f' % float(fc.get('precipitation', {}).get('@value'))).rstrip('0').rstrip('.').rjust(3),
 				)
-		# print(fc_str)
 		p.print(fc_str)
 
-	p.linefeed(3)
-
+	return p.printer.getvalue()
 
 
-# now = weather.now(as_json=True)
-
-# obj_now = json.loads(now) 
-
-# # pprint(obj_now)
-
+def render_header():
+	p = ThermalPrinter(printer=BytesIO())
+	p.rf()
 
-# print("Forecast: " + obj_now.get('symbol', {}).get('@name'))
-# print("Perciptations: "+obj_now.get('precipitation', {}).get('@value'))
-# print("Wind: "+obj_now.get('windSpeed', {}).get('@name') +" "+ obj_now.get('windDirection', {}).get('@name') )
-# print(obj_now.get('temperature', {}).get('@value'))
+	p.justify('c')
+	p.bold()
+	p.size(1, 1)
+	p.print(datetime.now().strftime("%-d %B %Y"))
+	p.print(datetime.now().strftime("%H:%M"))
+	p.linefeed()
 
+	return p.printer.getvalue()
+
+
+def fetch(cache):
+	""" Conditional GET of the forecast, returns the updated cache. """
+	headers = {}
+	if cache.get('etag'):
+		headers['If-None-Match'] = cache['etag']
+	if cache.get('last_modified'):
+		headers['If-Modified-Since'] = cache['last_modified']
+
+	try:
+		with urlopen(Request(FORECAST_URL, headers=headers), timeout=TIMEOUT) as response:
+			xml = response.read()
+			etag = response.headers.get('ETag')
+			last_modified = response.headers.get('Last-Modified')
+	except HTTPError as e:
+		if e.code != 304:
+			raise
+		# not modified, the prerendered body is still good
+		cache['fetched'] = time()
+		return cache
+
+	weather = xmltodict.parse(xml, force_list=('time',))
+	forecast = (((weather.get('weatherdata') or {}).get('forecast') or {}).get('tabular') or {}).get('time', [])
+	if not forecast:
+		# an odd reply, don't let it replace a good cached receipt
+		raise ValueError("No forecast in the reply from %s" % FORECAST_URL)
+
+	return {
+		'url': FORECAST_URL,
+		'fetched': time(),
+		'etag': etag,
+		'last_modified': last_modified,
+		'body': b64encode(render_body(forecast)).decode(),
+	}
+
+
+def refresh(cache):
+	""" Fetch only when the cached forecast is older than REFRESH. """
+	if time() - cache.get('fetched', 0) < REFRESH:
+		return cache
+
+	try:
+		cache = fetch(cache)
+	except (URLError, OSError, ValueError, ExpatError) as e:
+		# keep printing the stale forecast, retry on the next run
+		print("Forecast fetch failed: %s" % e)
+		return cache
+
+	save_cache(cache)
+	return cache
+
+
+def print_receipt():
+	with ThreadPoolExecutor(1) as pool:
+		# printer reset takes 2 s, overlap it with the cache check and fetch
+		warmup = pool.submit(ThermalPrinter)
+		cache = refresh(load_cache())
+		p = warmup.result()
+
+	if not cache.get('body'):
+		print("No forecast available")
+		return
+
+	p.printer.write(render_header() + b64decode(cache['body']))
+	p.linefeed(3)
 
-# # for forecast in weather.forecast():
-# for forecast in weather.forecast(as_json=True):
-#     print(forecast)
 
+def watch():
+	while True:
+		cache = refresh(load_cache())
+		sleep(max(cache.get('fetched', 0) + REFRESH - time(), 60))
 
-# p.size(3,2)
-# # p.d_height()
-# p.justify('c')
-# p.print("5678/912")
 
+if __name__ == '__main__':
+	if '--watch' in sys.argv:
+		watch()
+	else:
+		print_receipt()
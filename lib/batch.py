@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+    Batch printing: one warm printer connection for a whole stream of jobs.
+
+        python -m lib.batch labels.jsonl
+        python -m lib.batch --model dpt100s --throttle 0.5 labels.jsonl
+        cat labels.jsonl | python -m lib.batch --capture out.bin -
+        python -m lib.batch out.bin                  # replay a captured stream
+
+    Arguments ending with .bin are raw byte streams, sent as they are. Anything
+    else is read as JSON lines, one job per line:
+
+        {"text": "Hello, world!\\n"}
+        {"markup": "bc Title\\nnl body"}
+        {"image": "logo.png"}                        # relative to the jobs file
+        {"logo": "logo.png"}                         # through LogoRegistry
+        {"barcode": "5901234123457", "code": "EAN13"}
+        {"qr": "https://example.com"}
+        {"raw": "receipt.bin"}
+        {"feed": 3}
+
+    Extra keys are passed to the driver method as keyword arguments, e.g.
+    {"barcode": "12345", "code": "CODE39", "height": 60}.
+
+    --capture writes the byte stream to a file instead of the printer, and
+    --dry-run renders everything without writing it anywhere. Neither opens
+    the serial port, resets the printer or waits for it. --retries sends
+    bitmaps and raw streams through lib/transport.py, so they resume where
+    they stopped after the port stalls or is plugged back in.
+"""
+
+from lib.jobs import MODELS, run_job
+from tempfile import TemporaryDirectory
+from time import time, sleep
+import argparse
+import json
+import sys
+import os
+
+
+class Counter(object):
+    """ Writes through to target (or nowhere), counting the bytes. """
+
+    def __init__(self, target=None):
+        self.target = target
+        self.port = getattr(target, 'port', None)
+        self.bytes = 0
+
+    def write(self, data):
+        self.bytes += len(data)
+        if self.target is not None:
+            return self.target.write(data)
+        return len(data)
+
+    def flush(self):
+        if hasattr(self.target, 'flush'):
+            self.target.flush()
+
+    # port control for lib/transport.py
+    def open(self):
+        self.target.open()
+
+    def close(self):
+        self.target.close()
+
+    @property
+    def out_waiting(self):
+        return getattr(self.target, 'out_waiting', 0)
+
+    @property
+    def write_timeout(self):
+        return self.target.write_timeout
+
+    @write_timeout.setter
+    def write_timeout(self, seconds):
+        self.target.write_timeout = seconds
+
+
+def read_jobs(sources):
+    """ (job, base directory) for every job in the given files, '-' is stdin. """
+    for source in sources:
+        if source.endswith('.bin'):
+            yield {'raw': source}, '.'
+            continue
+
+        f = sys.stdin if source == '-' else open(source)
+        base = '.' if source == '-' else os.path.dirname(source)
+        with f:
+            for n, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line), base
+                except ValueError as e:
+                    raise Exception("ERROR: %s line %s: %s" % (source, n, e))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m lib.batch', description="Print a stream of jobs over one printer connection.")
+    parser.add_argument('jobs', nargs='+', help="JSON lines job files, raw .bin streams, - for stdin")
+    parser.add_argument('--model', choices=sorted(MODELS), default='portipc40')
+    parser.add_argument('--port', help="serial port, the driver's SERIALPORT by default")
+    parser.add_argument('--throttle', type=float, default=0, metavar='SECONDS', help="pause between jobs")
+    parser.add_argument('--capture', metavar='FILE', help="write the byte stream to FILE instead of the printer")
+    parser.add_argument('--dry-run', action='store_true', help="render the jobs, send nothing")
+    parser.add_argument('--stop-on-error', action='store_true')
+    parser.add_argument('--retries', type=int, default=0, metavar='N',
+                        help="reconnect and resume bitmaps and raw streams up to N times in a row when the port stalls")
+    args = parser.parse_args(argv)
+
+    from importlib import import_module
+    ThermalPrinter = import_module(MODELS[args.model]).ThermalPrinter
+
+    capture = None
+    if args.dry_run:
+        counter = Counter()
+        p = ThermalPrinter(printer=counter)
+    elif args.capture:
+        capture = open(args.capture, 'wb')
+        counter = Counter(capture)
+        p = ThermalPrinter(printer=counter)
+    else:
+        p = ThermalPrinter(serialport=args.port or ThermalPrinter.SERIALPORT)
+        counter = p.printer = Counter(p.printer)
+        if args.retries:
+            from lib.transport import Transport
+            Transport(p, retries=args.retries)
+
+    from lib.logos import LogoRegistry
+    if args.dry_run or args.capture:
+        # no printer memory behind a capture, keep the real index out of it
+        scratch = TemporaryDirectory()
+        logos = LogoRegistry(p, index_file=os.path.join(scratch.name, 'logos.json'))
+    else:
+        logos = LogoRegistry(p)
+
+    done = failed = 0
+    started = time()
+    try:
+        for job, base in read_jobs(args.jobs):
+            if done + failed and args.throttle:
+                sleep(args.throttle)
+            try:
+                run_job(p, job, base, logos)
+                done += 1
+            except Exception as e:
+                failed += 1
+                print("Job failed: %s: %s" % (json.dumps(job), e), file=sys.stderr)
+                if args.stop_on_error:
+                    break
+    finally:
+        counter.flush()
+        if capture is not None:
+            capture.close()
+
+    print("%s jobs, %s failed, %s bytes in %.1f s" % (done, failed, counter.bytes, time() - started), file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+    How long a job takes on a printer.
+
+        time = overhead + bytes * byte_time + dot lines * line_time
+
+    byte_time comes from the driver's BAUDRATE (10 bits per byte on the wire),
+    line_time from its PRINT_SPEED. The dot lines are counted by the driver's
+    scan(), which knows what text lines, size multipliers, feeds, graphic
+    lines and barcodes cost on that model.
+
+    Example:
+        from lib.portipc40 import ThermalPrinter
+        from lib.costmodel import CostModel
+
+        cost = CostModel(ThermalPrinter)
+        cost.estimate({"text": "Hello, world!\\n"})  # seconds
+        cost.estimate(captured_bytes)
+
+        # fit the coefficients to measured runs, keep them for next time
+        cost.calibrate([(job, seconds), ...]).save("pc40-cost.json")
+        p = ThermalPrinter()
+        p.cost = CostModel.load(ThermalPrinter, "pc40-cost.json")
+
+        # print with a live ETA
+        p.cost.send(p, data, progress=lambda sent, total, eta: print("%.1f s left" % eta))
+"""
+
+from time import time
+import json
+
+
+# 8N1: start bit, 8 data bits, stop bit
+BITS_PER_BYTE = 10
+# 203 dpi on both printers
+DOTS_PER_MM = 8
+
+
+class CostModel(object):
+
+    def __init__(self, printer_class, byte_time=None, line_time=None, overhead=0.0):
+        """ printer_class = a ThermalPrinter class, for its BAUDRATE, PRINT_SPEED and scan() """
+        self.printer_class = printer_class
+        self.byte_time = byte_time if byte_time is not None else BITS_PER_BYTE / float(printer_class.BAUDRATE)
+        self.line_time = line_time if line_time is not None else 1.0 / (printer_class.PRINT_SPEED * DOTS_PER_MM)
+        self.overhead = overhead
+
+    def render(self, job):
+        """ Printer bytes for a job: bytes as they are, str as text, dict as a job (lib/jobs.py). """
+        if isinstance(job, (bytes, bytearray, memoryview)):
+            return bytes(job)
+        if isinstance(job, str):
+            job = {'text': job}
+
+        from lib.jobs import run_job
+        from io import BytesIO
+        p = self.printer_class(printer=BytesIO())
+        run_job(p, job, '.')
+        return p.printer.getvalue()
+
+    def measure(self, job):
+        """ (bytes, dot lines) of a job. """
+        data = self.render(job)
+        return len(data), sum(lines for _, lines in self.printer_class.scan(data))
+
+    def time(self, n_bytes, lines):
+        return self.overhead + n_bytes * self.byte_time + lines * self.line_time
+
+    def estimate(self, job):
+        """ Seconds to transmit and print a job. """
+        return self.time(*self.measure(job))
+
+    def calibrate(self, runs):
+        """ Fit overhead, byte_time and line_time to measured runs, [(job, seconds), ...].
+            With too few or too similar runs the current coefficients are only scaled. """
+        samples = [(1.0,) + tuple(float(x) for x in self.measure(job)) for job, _ in runs]
+        seconds = [float(s) for _, s in runs]
+
+        # least squares: solve (A'A) x = A'b
+        ata = [[sum(a[i] * a[j] for a in samples) for j in range(3)] for i in range(3)]
+        atb = [sum(a[i] * s for a, s in zip(samples, seconds)) for i in range(3)]
+        fit = _solve(ata, atb)
+
+        if fit is not None and min(fit) >= 0:
+            self.overhead, self.byte_time, self.line_time = fit
+        else:
+            predicted = sum(self.time(n_bytes, lines) for _, n_bytes, lines in samples)
+            if predicted > 0:
+                factor = sum(seconds) / predicted
+                self.overhead *= factor
+                self.byte_time *= factor
+                self.line_time *= factor
+
+        return self
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({'overhead': self.overhead, 'byte_time': self.byte_time, 'line_time': self.line_time}, f)
+        return self
+
+    @classmethod
+    def load(cls, printer_class, path):
+        with open(path) as f:
+            return cls(printer_class, **json.load(f))
+
+    def send(self, printer, data, progress=None, chunk=256):
+        """ Write rendered bytes to printer (a ThermalPrinter) in chunks, calling
+            progress(sent, total, eta) after each one. eta is the model time left:
+            what is still to be sent, or what the printer still has to print of
+            what it got, whichever is longer. With a Transport attached the bytes
+            go through it in one resumable send() and sent follows its checkpoints. """
+        data = bytes(data)
+        events = self.printer_class.scan(data)
+        lines_left = sum(lines for _, lines in events)
+        total = self.time(len(data), lines_left)
+        started = time()
+        k = 0
+
+        def report(end):
+            nonlocal k, lines_left
+            while k < len(events) and events[k][0] <= end:
+                lines_left -= events[k][1]
+                k += 1
+            if progress is not None:
+                left = (len(data) - end) * self.byte_time + lines_left * self.line_time
+                progress(end, len(data), max(left, total - (time() - started), 0.0))
+
+        if printer.transport is not None:
+            printer.send(data, report)
+            return
+
+        for start in range(0, len(data), chunk):
+            end = min(start + chunk, len(data))
+            printer.send(data[start:end])
+            report(end)
+
+
+def _solve(a, b):
+    """ Gaussian elimination for a small square system, None if singular. """
+    n = len(b)
+    m = [row[:] + [b[i]] for i, row in enumerate(a)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(m[r][col]))
+        if abs(m[pivot][col]) < 1e-12:
+            return None
+        m[col], m[pivot] = m[pivot], m[col]
+        for r in range(n):
+            if r != col:
+                f = m[r][col] / m[col][col]
+                m[r] = [x - f * y for x, y in zip(m[r], m[col])]
+    return [m[i][n] / m[i][i] for i in range(n)]
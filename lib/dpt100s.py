@@ -4,6 +4,13 @@
 from serial import Serial
 from struct import pack, unpack
 from time import sleep
+try:
+    from lib.costmodel import CostModel
+    from lib import raster, symbols
+except ImportError:
+    # run as a script, python lib/<model>.py
+    from costmodel import CostModel
+    import raster, symbols
 import os
 
 
@@ -46,6 +53,18 @@ class ThermalPrinter(object):
     BAUDRATE = 19200
     TIMEOUT = 3
 
+    # 24 or 40 depending on the firmware
+    CHARS_PER_LINE = 24
+    # mm/s, for the cost model (lib/costmodel.py)
+    PRINT_SPEED = 50
+    # 48 mm at 8 dots/mm, wider bitmaps are scaled down (lib/raster.py prepare())
+    DOTS_PER_LINE = 384
+    # sent after a reconnect (lib/transport.py): NULs completing a command cut off
+    # halfway, at most an ESC W line or a barcode, then a reset
+    RESYNC = bytes(50) + b'\x1b\x40'
+    # seconds to wait after RESYNC before sending anything else, as in reset()
+    RESYNC_DELAY = 2
+
     # pixels with more color value (average for multiple channels) are counted as white
     # tweak this if your images appear too black or too white
     black_threshold = 48
@@ -53,14 +72,43 @@ class ThermalPrinter(object):
     alpha_threshold = 127
 
     printer = None
+    # wait for the printer after commands that keep it busy
+    paced = True
+    # CostModel for those waits, the uncalibrated one for this model if not set
+    cost = None
+    # resumable Transport for send(), see lib/transport.py
+    transport = None
+
+    # no downloadable graphics memory, see print_logo()
+    LOGO_SLOTS = 0
+    LOGO_SIZE = 0
+    LOGO_STOP = ()
 
     _ESC = b'\x1b'
     _GS = b'\x1d'
 
-    def __init__(self, heatTime=80, heatInterval=2, heatingDots=7, serialport=SERIALPORT):
+    # ESC c symbology letter and maximum data length
+    BARCODE_TYPES = {
+        'ITF':     (b'I', 12),
+        'CODE39':  (b'C', 10),
+        'CODABAR': (b'B', 10),
+        'EAN8':    (b'e', 8),
+        'EAN13':   (b'E', 13),
+    }
+    # ESC c HRI position, options bits 3,2
+    _HRI = (None, 'above', 'below', 'both')
+
+    def __init__(self, heatTime=80, heatInterval=2, heatingDots=7, serialport=SERIALPORT, printer=None):
+
+        if printer is not None:
+            # any object with write(), e.g. io.BytesIO to record a job for later.
+            # No reset and no pauses, nothing is listening on the other end.
+            self.printer = printer
+            self.paced = False
+            return
 
         if not os.path.exists(serialport):
-            raise("ERROR: Serial port not found at: %s" % serialport)
+            raise Exception("ERROR: Serial port not found at: %s" % serialport)
 
         self.printer = Serial(serialport, self.BAUDRATE, timeout=self.TIMEOUT)
 
@@ -81,11 +129,32 @@ class ThermalPrinter(object):
     #         sleep(0.01)
     #     return not bool(status & 0b00000100)
 
+    def pause(self, seconds):
+        if self.paced:
+            sleep(seconds)
+
+    def wait_for(self, data):
+        """ Pause for as long as the cost model says data takes to print. """
+        if not self.paced:
+            return
+        if self.cost is None:
+            self.cost = CostModel(type(self))
+        self.pause(self.cost.estimate(data))
+
+    def send(self, data, progress=None):
+        """ Write rendered bytes, resumable if a Transport is attached (lib/transport.py).
+            progress = called with the number of bytes sent so far """
+        if self.transport is not None:
+            return self.transport.send(data, progress)
+        self.printer.write(data)
+        if progress is not None:
+            progress(len(data))
+
     def reset(self):
         self.printer.write(self._ESC)
         self.printer.write(b'\x40') # @
         # heat up
-        sleep(2)
+        self.pause(2)
     
     # be careful!
     def factory_reset(self):
@@ -137,11 +206,13 @@ class ThermalPrinter(object):
     def graphic_mode(self):
         self.printer.write(b'\x11')
 
-    def print_logo(self):         
+    def print_logo(self, start=1, lines=85):
+        """ Print the graphic bank from flash (384 x 85 dots), from dot line start.
+            The bank is written with Custom's setup tools, there is no command to upload it,
+            so LogoRegistry (lib/logos.py) has no slots on this model. """
         self.printer.write(self._ESC)
         self.printer.write(b'\xfa')
-        self.printer.write(b'\x01')
-        self.printer.write(b'\x55')
+        self.printer.write(pack("BB", start, lines))
 
     def draw_line(self):
         self.printer.write(self._ESC)
@@ -159,45 +230,55 @@ class ThermalPrinter(object):
     #   lf._ESC)#     self.printer.write(chr(97))
     #     self.printer.write(chr(pos))
 
-#     def barcode_chr(self, msg):
-#         self.printer.write(chr(29)) # Leave
-#         self.printer.write(chr(72)) # Leave
-#         self.printer.write(msg)     # Print barcode # 1:Abovebarcode 2:Below 3:Both 0:Not printed
-
-#     def barcode_height(self, msg):
-#         self.printer.write(chr(29))  # Leave
-#         self.printer.write(chr(104)) # Leave
-#         self.printer.write(msg)      # Value 1-255 Default 50
-
-#     def barcode_height(self):
-#         self.printer.write(chr(29))  # Leave
-#         self.printer.write(chr(119)) # Leave
-#         self.printer.write(chr(2))   # Value 2,3 Default 2
-
-#     def barcode(self, msg):
-#         """ Please read http://www.adafruit.com/datasheets/A2-user%20manual.pdf
-#             for information on how to use barcodes. """
-#       
-#         self.printer.write(chr(29))  # LEAVE
-#         self.printer.write(chr(107)) # LEAVE
-#         self.printer.write(chr(65))  # USE ABOVE CHART
-#         self.printer.write(chr(12))  # USE CHART NUMBER OF CHAR
-#         self.printer.write(msg)
-
-# I Interleved 2/5
-# C Code 39
-# B CodaBar
-# e EAN8
-# E EAN13
-
-# //  Serial.write(0x1B);
-# //  Serial.write(0x63);
-# //  Serial.write('I'); //type
-# //  Serial.write(100); //height
-# //  Serial.write(0); //left margin
-# //  Serial.write(0b00100111); //options?
-# //  Serial.write(12); //length - 1 for some reason
-# //  Serial.print("+38268874693"); //data
+    # BARCODES
+    def barcode(self, data, code='EAN13', height=80, position=0, hri='below', size=1, check_digit=False):
+        """ Print a barcode with the printer's own symbol generator (ESC c),
+            a few bytes on the wire instead of a raster image.
+
+            data = barcode content, ASCII
+            code = ITF (Interleaved 2/5), CODE39, CODABAR, EAN8, EAN13 or UPCA (sent as EAN13
+                   with a leading zero). Other symbologies are rasterized, see lib/symbols.py
+            height = bar height in dot lines (1/8 mm)
+            position = left margin in 1/8 mm units
+            hri = human readable text: None, 'above', 'below' or 'both'
+            size = bar width multiplier, 1-4
+            check_digit = print the check digit
+        """
+        # normalised for the firmware table only, python-barcode wants e.g. gs1_128 as it is
+        name = code.upper().replace('-', '').replace('_', '')
+        if name == 'UPCA':
+            name, data = 'EAN13', '0' + data
+
+        if name not in self.BARCODE_TYPES:
+            return self.print_bitmap(*symbols.barcode(code, data, height, max_width=self.DOTS_PER_LINE))
+        code = name
+
+        # the length byte counts bytes, not characters
+        payload = str.encode(data)
+
+        letter, max_length = self.BARCODE_TYPES[code]
+        if len(payload) > max_length:
+            raise Exception("ERROR: %s barcode takes up to %s characters, got %s" % (code, max_length, len(payload)))
+
+        if hri is True:
+            hri = 'below'
+        options = int(bool(check_digit))
+        options |= self._HRI.index(hri or None) << 2
+        options |= (min(max(size, 1), 4) - 1) << 4
+
+        self.printer.write(self._ESC)
+        self.printer.write(b'\x63') # c
+        self.printer.write(letter)
+        self.printer.write(pack("BBBB", height, position, options, len(payload)))
+        self.printer.write(payload)
+
+    def qr(self, data, module=None, ec='M'):
+        """ No QR support in the firmware, so it goes out as a raster image. """
+        self.print_bitmap(*symbols.qr(data, module=module, ec=ec, max_width=self.DOTS_PER_LINE))
+
+    def pdf417(self, data, columns=4, security_level=2):
+        """ No 2D support in the firmware, so it goes out as a raster image. """
+        self.print_bitmap(*symbols.pdf417(data, columns=columns, security_level=security_level, max_width=self.DOTS_PER_LINE))
 
 
     # TEXT
@@ -209,153 +290,179 @@ class ThermalPrinter(object):
             inserts newlines after the given amount. Use normal '\n' line breaks for
             empty lines. """
         if not chars_per_line:
-            self.printer.write(str.encode(msg))
-            sleep(0.2)
+            data = str.encode(msg)
         else:
             l = list(msg)
             le = len(msg)
             for i in range(chars_per_line + 1, le, chars_per_line + 1):
                 l.insert(i, '\n')
-            self.printer.write(str.encode("".join(l)))
-            sleep(0.2)
-
-    # def print_markup(self, markup):
-    #     """ Print text with markup for styling.
-
-    #     Keyword arguments:
-    #     markup -- text with a left column of markup as follows:
-    #     first character denotes style (n=normal, b=bold, u=underline, i=inverse, f=font B)
-    #     second character denotes justification (l=left, c=centre, r=right)
-    #     third character must be a space, followed by the text of the line.
-    #     """
-    #     lines = markup.splitlines(True)
-    #     for l in lines:
-    #         style = l[0]
-    #         justification = l[1].upper()
-    #         text = l[3:]
-
-    #         if style == 'b':
-    #             self.bold()
-    #         elif style == 'u':
-    #            self.underline()
-    #         elif style == 'i':
-    #            self.inverse()
-    #         elif style == 'f':
-    #             self.font_b()
-
-    #         self.justify(justification)
-    #         self.print_text(text)
-    #         if justification != 'L':
-    #             self.justify()
-
-    #         if style == 'b':
-    #             self.bold(False)
-    #         elif style == 'u':
-    #            self.underline(False)
-    #         elif style == 'i':
-    #            self.inverse(False)
-    #         elif style == 'f':
-    #             self.font_b(False)
+            data = str.encode("".join(l))
+        self.printer.write(data)
+        self.wait_for(data)
+
+    def print_markup(self, markup):
+        """ Print text with markup for styling.
+
+        Keyword arguments:
+        markup -- text with a left column of markup as follows:
+        first character denotes style (n=normal, u=underline, w=double width, h=double height, e=expanded)
+        second character denotes justification (l=left, c=centre, r=right), padded with spaces
+        as the printer has no justification command
+        third character must be a space, followed by the text of the line.
+        Shorter lines, e.g. empty ones, print as empty lines.
+        """
+        lines = markup.splitlines()
+        for l in lines:
+            if len(l) < 3:
+                self.print()
+                continue
+            style = l[0]
+            justification = l[1].upper()
+            text = l[3:]
+
+            chars_per_line = self.CHARS_PER_LINE
+            if style == 'u':
+                self.underline()
+            elif style == 'w':
+                self.d_width()
+                chars_per_line //= 2
+            elif style == 'h':
+                self.d_height()
+            elif style == 'e':
+                self.expanded()
+                chars_per_line //= 2
+
+            if justification == 'C':
+                text = text.center(chars_per_line).rstrip()
+            elif justification == 'R':
+                text = text.rjust(chars_per_line)
+            self.print(text)
+
+            if style == 'u':
+                self.underline(False)
+            elif style in ('w', 'h', 'e'):
+                self.small()
+
+    @staticmethod
+    def scan(data, modes=None):
+        """ (offset, dot lines) for each command in a byte stream that moves the paper,
+            offset being where the command ends. For the cost model (lib/costmodel.py).
+
+            modes = dict, filled with the last command setting each print mode, to
+                    re-establish them after a reconnect (lib/transport.py)
+        """
+        if modes is None:
+            modes = {}
+        events = []
+        height = 1 # character height multiplier
+        pending = False # characters in the line buffer
+        i, n = 0, len(data)
+        while i < n:
+            b = data[i]
+            i += 1
+            if b == 0x1b:
+                # repeated ESC, as in ESC ESC @
+                while i < n and data[i] == 0x1b:
+                    i += 1
+            if b == 0x1b and i < n: # ESC
+                c = data[i]
+                i += 1
+                if c == 0x57: # W, 48 bytes graphic line
+                    i += 48
+                    events.append((i, 1))
+                elif c == 0x63 and i + 5 <= n: # c barcode
+                    lines, options, length = data[i + 1], data[i + 3], data[i + 4]
+                    i += 5 + length
+                    # HRI above, below or both
+                    hri = (options >> 2) & 3
+                    events.append((i, lines + (48 if hri == 3 else 24 if hri else 0)))
+                elif c == 0xfa and i + 2 <= n: # graphic bank
+                    start, lines = data[i], data[i + 1]
+                    i += 2
+                    events.append((i, max(0, min(lines, 86 - start))))
+                elif c == 0x41 and i + 2 <= n: # A, dot feed
+                    i += 2
+                    events.append((i, data[i - 2] * 256 + data[i - 1]))
+                elif c == 0x23: # #
+                    i += 1
+                elif c == 0x40: # @
+                    modes.clear()
+                    height = 1
+                elif c in (0x51, 0x71): # Q, q
+                    modes['underline'] = data[i - 2:i]
+                elif c in (0x52, 0x4e): # R, N
+                    modes['reverse'] = data[i - 2:i]
+            elif b == 0x1d and i < n: # GS
+                c = data[i]
+                i += 1
+                if c == 0x57 and i < n: # W, n bytes graphic line
+                    i += 1 + data[i]
+                    events.append((i, 1))
+                elif c in (0x24, 0x49): # $, I
+                    i += 1
+            elif b in (0x00, 0x01, 0x04):
+                height = 1
+                modes['size'] = data[i - 1:i]
+            elif b in (0x02, 0x03):
+                height = 2
+                modes['size'] = data[i - 1:i]
+            elif b in (0x0a, 0x0b) or (b == 0x0d and pending):
+                events.append((i, 24 * height))
+                pending = False
+            elif b >= 0x20:
+                pending = True
+
+        return events
 
     def convert_pixel_array_to_binary(self, pixels, w, h):
         """ Convert the pixel array into a black and white plain list of 1's and 0's
-            width is enforced to 384 and padded with white if needed. """
-        black_and_white_pixels = [1] * 384 * h
-        if w > 384:
-            print("Bitmap width too large: %s. Needs to be under 384" % w)
-            return False
-        elif w < 384:
-            print("Bitmap under 384 (%s), padding the rest with white" % w)
-
-        print("Bitmap size", w)
-
-        if type(pixels[0]) == int: # single channel
-            print(" => single channel")
-            for i, p in enumerate(pixels):
-                if p < self.black_threshold:
-                    black_and_white_pixels[i % w + int(i / w) * 384] = 0
-                else:
-                    black_and_white_pixels[i % w + int(i / w) * 384] = 1
-        elif type(pixels[0]) in (list, tuple) and len(pixels[0]) == 3: # RGB
-            print(" => RGB channel")
-            for i, p in enumerate(pixels):
-                if sum(p[0:2]) / 3.0 < self.black_threshold:
-                    black_and_white_pixels[i % w + int(i / w) * 384] = 0
-                else:
-                    black_and_white_pixels[i % w + int(i / w) * 384] = 1
-        elif type(pixels[0]) in (list, tuple) and len(pixels[0]) == 4: # RGBA
-            print(" => RGBA channel")
-            for i, p in enumerate(pixels):
-                if sum(p[0:2]) / 3.0 < self.black_threshold and p[3] > self.alpha_threshold:
-                    black_and_white_pixels[i % w + int(i / w) * 384] = 0
-                else:
-                    black_and_white_pixels[i % w + int(i / w) * 384] = 1
-        else:
-            print("Unsupported pixels array type. Please send plain list (single channel, RGB or RGBA)")
-            print("Type pixels[0]", type(pixels[0]), "haz", pixels[0])
-            return False
+            scaled down to DOTS_PER_LINE if wider and padded with white if narrower. """
+        pixels, w, h = raster.prepare(pixels, w, h, self.DOTS_PER_LINE, alpha_threshold=self.alpha_threshold)
+        packed = raster.pack(pixels, w, h, self.black_threshold, self.alpha_threshold, self.DOTS_PER_LINE)
+        return [0 if packed[i >> 3] & (0x80 >> (i & 7)) else 1 for i in range(self.DOTS_PER_LINE * h)]
 
-        return black_and_white_pixels
+    @staticmethod
+    def render_bitmap(pixels, w, h, black_threshold=black_threshold, alpha_threshold=alpha_threshold):
+        """ Bitmap as printer bytes, one ESC W graphic line (48 bytes) per dot line.
+            Depends on its arguments only, so it can run in a worker process (lib/pipeline.py). """
+        packed = raster.pack(pixels, w, h, black_threshold, alpha_threshold, ThermalPrinter.DOTS_PER_LINE)
 
+        print_bytes = bytearray()
+        for y in range(h):
+            print_bytes += ThermalPrinter._ESC + b'\x57' + packed[y * 48:(y + 1) * 48]
 
-    def print_bitmap(self, pixels, w, h, output_png=False):
-        """ Best to use images that have a pixel width of 384 as this corresponds
-            to the printer row width.
+        return bytes(print_bytes)
 
-            pixels = a pixel array. RGBA, RGB, or one channel plain list of values (ranging from 0-255).
-            w = width of image
-            h = height of image
+    def print_bitmap(self, pixels, w=None, h=None, output_png=False, fit='fit', dither=False):
+        """ Best to use images that have a pixel width of 384 as this corresponds
+            to the printer row width. Wider images are scaled down to it.
+
+            pixels = a PIL image (L, 1, RGB, RGBA...), a NumPy array, a buffer (bytes, memoryview...)
+                     with one channel, RGB or RGBA rows, or a plain list of values as from getdata().
+                     See lib/raster.py.
+            w = width of image, taken from the image or array if not set
+            h = height of image, taken from the image or array if not set
+            fit = 'fit' (shrink wider images), 'scale' (any image to the full width) or 'crop'
+            dither = Floyd-Steinberg dithering instead of black_threshold, for photos
             if "output_png" is set, prints an "print_bitmap_output.png" in the same folder using the same
             thresholds as the actual printing commands. Useful for seeing if there are problems with the
             original image (this requires PIL).
 
             Example code with PIL:
-                import Image, ImageDraw
+                from PIL import Image
                 i = Image.open("lammas_grayscale-bw.png")
-                data = list(i.getdata())
-                w, h = i.size
-                p.print_bitmap(data, w, h)
+                p.print_bitmap(i)
         """
-        counter = 0
-        if output_png:
-            from PIL import Image, ImageDraw
-            test_img = Image.new('RGB', (384, h))
-            draw = ImageDraw.Draw(test_img)
-
-        # self.linefeed()
-
-        black_and_white_pixels = self.convert_pixel_array_to_binary(pixels, w, h)
-        print_bytes = []
-
-        # read the bytes into an array
-        for rowStart in range(0, h, 256):
-            chunkHeight = 255 if (h - rowStart) > 255 else h - rowStart
-            print_bytes += (18, 42, chunkHeight, 48)
-
-            for i in range(0, 48 * chunkHeight):
-                # read one byte in
-                byt = 0
-                for xx in range(8):
-                    pixel_value = black_and_white_pixels[counter]
-                    counter += 1
-                    # check if this is black
-                    if pixel_value == 0:
-                        byt += 1 << (7 - xx)
-                        if output_png: draw.point((counter % 384, round(counter / 384)), fill=(0, 0, 0))
-                    # it's white
-                    else:
-                        if output_png: draw.point((counter % 384, round(counter / 384)), fill=(255, 255, 255))
-
-                print_bytes.append(byt)
-       
-        i = 0
-        for b in print_bytes:
-            if i%48 == 0 and i < len(print_bytes)-48:
-                self.draw_line()
-            self.printer.write(pack("B", b))
-            i = i+1
+        pixels, w, h = raster.prepare(pixels, w, h, self.DOTS_PER_LINE, fit, dither, self.alpha_threshold)
+
+        print_bytes = self.render_bitmap(pixels, w, h, self.black_threshold, self.alpha_threshold)
+        self.send(print_bytes)
 
         if output_png:
+            from PIL import Image
+            # ESC W + 48 bytes per line, 1 is black where PIL's "1" mode has white
+            lines = b"".join(print_bytes[y * 50 + 2:(y + 1) * 50] for y in range(h))
+            test_img = Image.frombytes('1', (self.DOTS_PER_LINE, h), bytes(b ^ 0xff for b in lines))
             test_print = open('print-output.png', 'wb')
             test_img.save(test_print, 'PNG')
             print("output saved to %s" % test_print.name)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+    Print jobs as plain dicts, shared by lib/batch.py, lib/server.py and
+    lib/costmodel.py. See lib/batch.py for the job format.
+"""
+
+import json
+import os
+
+
+MODELS = {
+    'dpt100s': 'lib.dpt100s',
+    'portipc40': 'lib.portipc40',
+}
+
+
+# one of these keys names what a job prints, the other keys are arguments
+KINDS = ('text', 'markup', 'image', 'logo', 'barcode', 'qr', 'raw', 'feed')
+
+
+def job_kind(job):
+    """ The one KINDS key of a job. """
+    kinds = [k for k in KINDS if k in job] if isinstance(job, dict) else []
+    if len(kinds) != 1:
+        raise Exception("ERROR: A job needs exactly one of %s: %s" % (", ".join(KINDS), json.dumps(job)))
+    return kinds[0]
+
+
+def run_job(p, job, base, logos=None):
+    """ Print a job on p, a ThermalPrinter. File names are relative to base. """
+    job = dict(job)
+    kind = job_kind(job)
+
+    def path(name):
+        return os.path.join(base, job.pop(name))
+
+    if kind == 'text':
+        p.print_text(job.pop('text'), **job)
+    elif kind == 'markup':
+        p.print_markup(job.pop('markup'))
+    elif kind == 'image':
+        from PIL import Image
+        p.print_bitmap(Image.open(path('image')), **job)
+    elif kind == 'logo':
+        from PIL import Image
+        if logos is None:
+            p.print_bitmap(Image.open(path('logo')))
+        else:
+            logos.print_logo(Image.open(path('logo')))
+    elif kind == 'barcode':
+        p.barcode(job.pop('barcode'), **job)
+    elif kind == 'qr':
+        p.qr(job.pop('qr'), **job)
+    elif kind == 'raw':
+        with open(path('raw'), 'rb') as f:
+            data = f.read()
+        p.send(data)
+        # the printer takes the bytes faster than it prints them
+        p.wait_for(data)
+    else:
+        p.linefeed(job.pop('feed'))
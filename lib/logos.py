@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+    Logos kept in printer memory: each image is uploaded once and printed
+    again with a few byte recall command instead of the whole bitmap.
+
+    Example:
+        from lib.portipc40 import ThermalPrinter
+        from lib.logos import LogoRegistry
+        from PIL import Image
+
+        p = ThermalPrinter()
+        logos = LogoRegistry(p)
+        logos.print_logo(Image.open("logo.png"))  # uploads, then recalls
+        logos.print_logo(Image.open("logo.png"))  # recall only
+
+    The host side index (INDEX_FILE) maps the hash of the rendered bitmap to
+    the printer slot holding it, so it survives process restarts. Slots are
+    reused least recently used first. The printer can't report what it holds,
+    call forget() after switching it off or after writing its memory by
+    other means.
+
+    Memory is model specific: the PORTI-PC40 has one macro of 2048 bytes,
+    enough for a small logo (e.g. 192 x 72 dots). The DPT100-S can't upload
+    graphics over serial at all; there, for logos too big for a slot and for
+    bitmaps whose bytes happen to end the macro definition (GS : or GS ^),
+    print_logo() simply prints the bitmap.
+"""
+
+from hashlib import sha1
+from time import time
+import json
+import os
+
+
+class LogoRegistry(object):
+
+    INDEX_FILE = os.path.expanduser("~/.cache/thermalprinter-logos.json")
+
+    def __init__(self, printer, index_file=INDEX_FILE, name=None):
+        """ printer = a ThermalPrinter
+            name = key of this printer in the index, model and serial port by default
+        """
+        self.printer = printer
+        self.index_file = index_file
+        self.name = name or "%s:%s" % (type(printer).__module__, getattr(printer.printer, 'port', None))
+
+    def _load(self):
+        try:
+            with open(self.index_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, index):
+        os.makedirs(os.path.dirname(self.index_file) or '.', exist_ok=True)
+        tmp = self.index_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp, self.index_file)
+
+    def slots(self):
+        """ {slot: {'hash', 'size', 'used'}} of what this printer holds. """
+        return self._load().get(self.name, {})
+
+    def forget(self):
+        """ Drop everything recorded for this printer, e.g. after a power cycle. """
+        index = self._load()
+        if index.pop(self.name, None) is not None:
+            self._save(index)
+
+    def print_logo(self, pixels, w=None, h=None, fit='fit', dither=False):
+        """ Print an image from printer memory, uploading it first if needed.
+            Same arguments as print_bitmap(). Returns the slot used, None if the
+            bitmap was sent as is. """
+        from lib import raster
+        p = self.printer
+        pixels, w, h = raster.prepare(pixels, w, h, p.DOTS_PER_LINE, fit, dither, p.alpha_threshold)
+
+        data = p.render_bitmap(pixels, w, h, p.black_threshold, p.alpha_threshold)
+        key = sha1(data).hexdigest()
+
+        # too big, or holding bytes that would cut the upload short
+        if not p.LOGO_SLOTS or len(data) > p.LOGO_SIZE or any(stop in data for stop in p.LOGO_STOP):
+            p.send(data)
+            return None
+
+        # re-read, another process may have changed the printer memory since
+        index = self._load()
+        slots = index.setdefault(self.name, {})
+
+        slot = next((s for s, logo in slots.items() if logo['hash'] == key), None)
+        if slot is None:
+            free = [str(s) for s in range(p.LOGO_SLOTS) if str(s) not in slots]
+            slot = free[0] if free else min(slots, key=lambda s: slots[s]['used'])
+
+            p.store_logo(int(slot), data)
+            if hasattr(p.printer, 'flush'):
+                p.printer.flush()
+            slots[slot] = {'hash': key, 'size': len(data)}
+
+        p.recall_logo(int(slot))
+        slots[slot]['used'] = time()
+        self._save(index)
+
+        return int(slot)
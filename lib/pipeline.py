@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+    Pipelined printing: bitmaps are converted and packed in worker processes
+    while a writer thread keeps the serial link busy with what is already
+    rendered. A batch of images takes about max(CPU time, link time) instead
+    of their sum.
+
+    Example:
+        from lib.dpt100s import ThermalPrinter
+        from lib.pipeline import PrintPipeline
+
+        p = ThermalPrinter()
+        with PrintPipeline(p) as pipe:
+            for image in images:
+                pipe.print_bitmap(image)
+                pipe.write(b'\\n')
+"""
+
+from concurrent.futures import ProcessPoolExecutor, Future
+from lib import raster
+from threading import Thread
+from queue import Queue
+
+
+class PrintPipeline(object):
+    """
+        Tall images are split into bands of BAND_HEIGHT dot lines, each band is a
+        separate job for the pool. At most `depth` rendered or in flight jobs wait
+        for the writer, so producers block instead of piling up memory.
+
+        printer = a ThermalPrinter, its render_bitmap() runs in the workers and
+                  everything is written to its port in submission order
+        workers = worker processes, one per core by default
+    """
+
+    # multiple of 24, the PORTI-PC40 band height
+    BAND_HEIGHT = 240
+
+    def __init__(self, printer, workers=None, depth=8):
+        self.printer = printer
+        self.pool = ProcessPoolExecutor(workers)
+        self.queue = Queue(depth)
+        self.error = None
+
+        self.writer = Thread(target=self._write, daemon=True)
+        self.writer.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _write(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            # keep draining after an error so producers never block on a full queue
+            if self.error is not None:
+                continue
+            try:
+                if isinstance(job, Future):
+                    job = job.result()
+                self.printer.send(job)
+            except Exception as e:
+                self.error = e
+
+    def write(self, data):
+        """ Queue raw bytes (text, commands) in order with the bitmaps. """
+        self.queue.put(data)
+
+    def print_bitmap(self, pixels, w=None, h=None, fit='fit', dither=False):
+        """ Same arguments as ThermalPrinter.print_bitmap(), returns once all bands are queued. """
+        pixels, w, h = raster.prepare(pixels, w, h, self.printer.DOTS_PER_LINE, fit, dither, self.printer.alpha_threshold)
+
+        render = type(self.printer).render_bitmap
+        for y0 in range(0, h, self.BAND_HEIGHT):
+            y1 = min(h, y0 + self.BAND_HEIGHT)
+            self.queue.put(self.pool.submit(
+                render, raster.band(pixels, w, h, y0, y1), w, y1 - y0,
+                self.printer.black_threshold, self.printer.alpha_threshold,
+            ))
+
+    def close(self):
+        """ Wait until everything is written, re-raises the first error. """
+        self.queue.put(None)
+        self.writer.join()
+        self.pool.shutdown()
+
+        if self.error is not None:
+            raise self.error
@@ -4,6 +4,13 @@
 from serial import Serial
 from struct import pack, unpack
 from time import sleep
+try:
+    from lib.costmodel import CostModel
+    from lib import raster, symbols
+except ImportError:
+    # run as a script, python lib/<model>.py
+    from costmodel import CostModel
+    import raster, symbols
 import os
 import math
 
@@ -48,18 +55,53 @@ class ThermalPrinter(object):
     TIMEOUT = 3
 
     CHARS_PER_LINE = 31
+    # mm/s, for the cost model (lib/costmodel.py)
+    PRINT_SPEED = 50
+    # 48 mm at 8 dots/mm, wider bitmaps are scaled down (lib/raster.py prepare())
+    DOTS_PER_LINE = 384
+    # sent after a reconnect (lib/transport.py): NULs completing a command cut off
+    # halfway, at most an ESC * band, then a reset
+    RESYNC = bytes(5 + 3 * DOTS_PER_LINE) + b'\x1b\x40'
+    # seconds to wait after RESYNC before sending anything else, as in reset()
+    RESYNC_DELAY = 0.2 + 2
 
     # pixels with more color value (average for multiple channels) are counted as white
     # tweak this if your images appear too black or too white
-    # black_threshold = 48
+    black_threshold = 48
     # pixels with less alpha than this are counted as white
-    # alpha_threshold = 127
+    alpha_threshold = 127
 
     printer = None
+    # wait for the printer after commands that keep it busy
+    paced = True
+    # CostModel for those waits, the uncalibrated one for this model if not set
+    cost = None
+    # resumable Transport for send(), see lib/transport.py
+    transport = None
+
+    # downloaded memory for LogoRegistry (lib/logos.py): one macro, up to 2048 bytes.
+    # Kept over ESC @, lost when the printer is switched off.
+    LOGO_SLOTS = 1
+    LOGO_SIZE = 2048
+    # GS : ends a macro definition and GS ^ aborts it, bitmaps holding either can't be stored
+    LOGO_STOP = (b'\x1d\x3a', b'\x1d\x5e')
 
     _ESC = b'\x1b'
     _GS = b'\x1d'
 
+    # GS k symbology (function B, length prefixed) and accepted data lengths
+    BARCODE_TYPES = {
+        'UPCA':    (65, 11, 12),
+        'UPCE':    (66, 11, 12),
+        'EAN13':   (67, 12, 13),
+        'EAN8':    (68, 7, 8),
+        'CODE39':  (69, 1, 255),
+        'ITF':     (70, 1, 255),
+        'CODABAR': (71, 1, 255),
+        'CODE93':  (72, 1, 255),
+        'CODE128': (73, 2, 255), # code set prefix included
+    }
+
     def esc(self):
         self.printer.write(self._ESC)
 
@@ -67,7 +109,14 @@ class ThermalPrinter(object):
         self.printer.write(self._GS)
 
 
-    def __init__(self, heatTime=80, heatInterval=2, heatingDots=7, serialport=SERIALPORT):
+    def __init__(self, heatTime=80, heatInterval=2, heatingDots=7, serialport=SERIALPORT, printer=None):
+
+        if printer is not None:
+            # any object with write(), e.g. io.BytesIO to record a job for later.
+            # No reset and no pauses, nothing is listening on the other end.
+            self.printer = printer
+            self.paced = False
+            return
 
         if not os.path.exists(serialport):
             raise Exception("ERROR: Serial port not found at: %s" % serialport)
@@ -77,15 +126,36 @@ class ThermalPrinter(object):
         #reset
         self.reset()
 
+    def pause(self, seconds):
+        if self.paced:
+            sleep(seconds)
+
+    def wait_for(self, data):
+        """ Pause for as long as the cost model says data takes to print. """
+        if not self.paced:
+            return
+        if self.cost is None:
+            self.cost = CostModel(type(self))
+        self.pause(self.cost.estimate(data))
+
+    def send(self, data, progress=None):
+        """ Write rendered bytes, resumable if a Transport is attached (lib/transport.py).
+            progress = called with the number of bytes sent so far """
+        if self.transport is not None:
+            return self.transport.send(data, progress)
+        self.printer.write(data)
+        if progress is not None:
+            progress(len(data))
+
     def reset(self):
         self.esc()
         self.esc()
         self.printer.write(b'\x40') # @ - reset 
-        sleep(0.2)
+        self.pause(0.2)
         self.esc()
         self.printer.write(b'\x53') # S - standard mode
         # heat up
-        sleep(2)
+        self.pause(2)
         self.rf()
 
 
@@ -212,6 +282,257 @@ class ThermalPrinter(object):
             self.printer.write(b'\x00') # left
 
 
+    # BARCODES
+    def barcode(self, data, code='EAN13', height=80, width=0, hri=True):
+        """ Print a barcode with the printer's own symbol generator (GS k),
+            a few bytes on the wire instead of a raster image.
+
+            data = barcode content, ASCII
+            code = UPCA, UPCE, EAN13, EAN8, CODE39, ITF (Interleaved 2/5), CODABAR, CODE93
+                   or CODE128. Other symbologies are rasterized, see lib/symbols.py
+            height = bar height in dots (1/8 mm)
+            width = horizontal size, 0 (default) or 3-5
+            hri = print human readable text below the bars
+        """
+        # normalised for the firmware table only, python-barcode wants e.g. gs1_128 as it is
+        name = code.upper().replace('-', '').replace('_', '')
+
+        if name not in self.BARCODE_TYPES:
+            return self.print_bitmap(*symbols.barcode(code, data, height, max_width=self.DOTS_PER_LINE))
+        code = name
+
+        payload = self._code128(data) if code == 'CODE128' else str.encode(data)
+
+        m, min_length, max_length = self.BARCODE_TYPES[code]
+        if not min_length <= len(payload) <= max_length:
+            raise Exception("ERROR: %s barcode takes %s-%s characters, got %s" % (code, min_length, max_length, len(payload)))
+
+        self.gs()
+        self.printer.write(b'\x68') # h
+        self.printer.write(pack("B", height))
+
+        self.gs()
+        self.printer.write(b'\x77') # w
+        self.printer.write(pack("B", width))
+
+        self.gs()
+        self.printer.write(b'\x48') # H
+        if hri:
+            self.printer.write(b'\x01')
+        else:
+            self.printer.write(b'\x00')
+
+        self.gs()
+        self.printer.write(b'\x6b') # k
+        self.printer.write(pack("BB", m, len(payload)))
+        self.printer.write(payload)
+
+    @staticmethod
+    def _code128(data):
+        """ CODE128 data with its code set prefix: {C (a byte per digit pair) for an even
+            number of digits, {B otherwise. Data already starting with {A, {B or {C is sent as is. """
+        if data[:2] in ('{A', '{B', '{C'):
+            return str.encode(data)
+        if data.isdigit() and len(data) % 2 == 0:
+            return b'{C' + bytes(int(data[i:i + 2]) for i in range(0, len(data), 2))
+        return b'{B' + str.encode(data.replace('{', '{{'))
+
+    def pdf417(self, data, columns=4, security_level=2, ratio=3):
+        """ Print a PDF417 symbol with the printer's own 2D generator (ESC Z).
+
+            columns = 1-7
+            security_level = error correction, 0-8
+            ratio = module height to width, 2-5
+        """
+        b_data = str.encode(data)
+
+        self.esc()
+        self.printer.write(b'\x5a') # Z
+        self.printer.write(pack("<BBBH", columns, security_level, ratio, len(b_data)))
+        self.printer.write(b_data)
+
+    def qr(self, data, module=None, ec='M'):
+        """ No QR support in the firmware, so it goes out as a raster image. """
+        self.print_bitmap(*symbols.qr(data, module=module, ec=ec, max_width=self.DOTS_PER_LINE))
+
+
+    # BITMAP
+    @staticmethod
+    def scan(data, modes=None):
+        """ (offset, dot lines) for each command in a byte stream that moves the paper,
+            offset being where the command ends. For the cost model (lib/costmodel.py).
+
+            modes = dict, filled with the last command setting each print mode, to
+                    re-establish them after a reconnect (lib/transport.py)
+        """
+        if modes is None:
+            modes = {}
+        events = []
+        spacing = 30 # ESC 2, 1/7 inch
+        height = 1 # character height multiplier
+        barcode_height, hri = 80, False
+        pending = False # characters or graphics in the line buffer
+        macro, macro_lines = None, 0
+        i, n = 0, len(data)
+
+        def feed(lines):
+            if macro is None:
+                events.append((i, lines))
+            else:
+                macro.append(lines)
+
+        while i < n:
+            b = data[i]
+            i += 1
+            if b == 0x1b:
+                # repeated ESC, as in the reset sequence ESC ESC @
+                while i < n and data[i] == 0x1b:
+                    i += 1
+            c = data[i] if i < n else None
+            if b == 0x1b and c is not None: # ESC
+                i += 1
+                if c == 0x40: # @
+                    spacing, height = 30, 1
+                    modes.clear()
+                elif c == 0x32: # 2
+                    spacing = 30
+                    modes['spacing'] = data[i - 2:i]
+                elif c == 0x33 and i < n: # 3
+                    spacing = data[i]
+                    i += 1
+                    modes['spacing'] = data[i - 3:i]
+                elif c == 0x4a and i < n: # J, dot feed
+                    i += 1
+                    feed(data[i - 1])
+                    pending = False
+                elif c == 0x64 and i < n: # d, line feed
+                    i += 1
+                    feed(data[i - 1] * spacing)
+                    pending = False
+                elif c == 0x2a and i + 3 <= n: # * bit image
+                    m, columns = data[i], data[i + 1] + 256 * data[i + 2]
+                    i += 3 + columns * (3 if m in (32, 33) else 1)
+                    pending = True
+                elif c == 0x5a and i + 5 <= n: # Z, PDF417
+                    columns, level, ratio = max(data[i], 1), data[i + 1], data[i + 2]
+                    length = data[i + 3] + 256 * data[i + 4]
+                    i += 5 + length
+                    # rough: 2 dot modules, about 2 bytes per codeword plus error correction
+                    rows = max(3, -(-(length // 2 + 2 ** (level + 1) + 1) // columns))
+                    feed(rows * ratio * 2 + 8)
+                elif c in (0x21, 0x2d, 0x45, 0x7b, 0x61, 0x20, 0x52, 0x74, 0x47, 0x4d, 0x54):
+                    i += 1
+                    modes[data[i - 3:i - 1]] = data[i - 3:i]
+                elif c in (0x24, 0x5c, 0x63):
+                    i += 2
+            elif b == 0x1d and c is not None: # GS
+                i += 1
+                if c == 0x21 and i < n: # ! size, high nibble is the height here
+                    height = (data[i] >> 4) + 1
+                    i += 1
+                    modes['size'] = data[i - 3:i]
+                elif c == 0x68 and i < n: # h
+                    barcode_height = data[i]
+                    i += 1
+                    modes[data[i - 3:i - 1]] = data[i - 3:i]
+                elif c == 0x48 and i < n: # H
+                    hri = bool(data[i] & 1)
+                    i += 1
+                    modes[data[i - 3:i - 1]] = data[i - 3:i]
+                elif c == 0x6b and i < n: # k barcode
+                    m = data[i]
+                    if m >= 65 and i + 1 < n:
+                        i += 2 + data[i + 1]
+                    else:
+                        end = data.find(b'\x00', i + 1)
+                        i = n if end < 0 else end + 1
+                    feed(barcode_height + (24 if hri else 0))
+                elif c == 0x3a: # : macro definition start/end
+                    if macro is None:
+                        macro = []
+                    else:
+                        macro_lines, macro = sum(macro), None
+                elif c == 0x5e and i + 3 <= n: # ^ execute macro
+                    i += 3
+                    feed(macro_lines * data[i - 3])
+                elif c in (0x42, 0x77): # B, w
+                    i += 1
+                    modes[data[i - 3:i - 1]] = data[i - 3:i]
+                elif c in (0x4c, 0x50, 0x57): # L, P, W
+                    i += 2
+                    modes[data[i - 4:i - 2]] = data[i - 4:i]
+                elif c in (0x24, 0x5c):
+                    i += 2
+            elif b == 0x0a:
+                feed(max(spacing, 24 * height) if pending else spacing)
+                pending = False
+            elif b >= 0x20:
+                pending = True
+
+        return events
+
+    @staticmethod
+    def render_bitmap(pixels, w, h, black_threshold=black_threshold, alpha_threshold=alpha_threshold):
+        """ Bitmap as printer bytes in 24 dot bands (ESC * 33) of w columns, each followed by a
+            24 dot feed. Depends on its arguments only, so it can run in a worker process (lib/pipeline.py). """
+        packed = raster.pack(pixels, w, h, black_threshold, alpha_threshold, ThermalPrinter.DOTS_PER_LINE)
+        line_bytes = ThermalPrinter.DOTS_PER_LINE // 8
+        blank = bytes(line_bytes)
+
+        print_bytes = bytearray()
+        for band in range(0, h, 24):
+            rows = [packed[y * line_bytes:(y + 1) * line_bytes] if y < h else blank for y in range(band, band + 24)]
+
+            print_bytes += ThermalPrinter._ESC + b'\x2a\x21' # * 24 dot double density
+            print_bytes += pack("<H", w)
+            # column major, 3 bytes per column, top dot in the MSB
+            for x in range(w):
+                col, mask = x >> 3, 0x80 >> (x & 7)
+                for y0 in range(0, 24, 8):
+                    byt = 0
+                    for yy in range(8):
+                        if rows[y0 + yy][col] & mask:
+                            byt |= 0x80 >> yy
+                    print_bytes.append(byt)
+            # print and feed one band
+            print_bytes += ThermalPrinter._ESC + b'\x4a\x18' # J
+
+        return bytes(print_bytes)
+
+    def print_bitmap(self, pixels, w=None, h=None, fit='fit', dither=False):
+        """ Print a bitmap in 24 dot bands. Images wider than DOTS_PER_LINE are scaled down.
+
+            pixels = a PIL image (L, 1, RGB, RGBA...), a NumPy array, a buffer (bytes, memoryview...)
+                     with one channel, RGB or RGBA rows, or a plain list of values as from getdata().
+                     See lib/raster.py.
+            w = width of image, taken from the image or array if not set
+            h = height of image, taken from the image or array if not set
+            fit = 'fit' (shrink wider images), 'scale' (any image to the full width) or 'crop'
+            dither = Floyd-Steinberg dithering instead of black_threshold, for photos
+        """
+        pixels, w, h = raster.prepare(pixels, w, h, self.DOTS_PER_LINE, fit, dither, self.alpha_threshold)
+
+        self.send(self.render_bitmap(pixels, w, h, self.black_threshold, self.alpha_threshold))
+
+    # LOGOS
+    def store_logo(self, slot, data):
+        """ Record rendered bitmap bytes as the macro, without printing them. """
+        if any(stop in data for stop in self.LOGO_STOP):
+            raise Exception("ERROR: Bitmap contains GS : or GS ^, it would end the macro definition")
+        self.gs()
+        self.printer.write(b'\x3a') # : start macro definition
+        self.printer.write(data)
+        self.gs()
+        self.printer.write(b'\x3a') # : end macro definition
+
+    def recall_logo(self, slot):
+        self.gs()
+        self.printer.write(b'\x5e') # ^ execute macro
+        self.printer.write(b'\x01') # once
+        self.printer.write(b'\x00') # no wait
+        self.printer.write(b'\x00') # right away
+
+
     # TEXT
     def print(self, msg=""):
         self.print_text(msg+"\n")
@@ -222,53 +543,57 @@ class ThermalPrinter(object):
             inserts newlines after the given amount. Use normal '\n' line breaks for
             empty lines. """
         if not chars_per_line:
-            self.printer.write(str.encode(msg))
-            sleep(0.3)
+            data = str.encode(msg)
         else:
             l = list(msg)
             le = len(msg)
             for i in range(chars_per_line + 1, le, chars_per_line + 1):
                 l.insert(i, '\n')
-            self.printer.write(str.encode("".join(l)))
-            sleep(0.3)
-
-    # def print_markup(self, markup):
-    #     """ Print text with markup for styling.
-
-    #     Keyword arguments:
-    #     markup -- text with a left column of markup as follows:
-    #     first character denotes style (n=normal, b=bold, u=underline, i=inverse, f=font B)
-    #     second character denotes justification (l=left, c=centre, r=right)
-    #     third character must be a space, followed by the text of the line.
-    #     """
-    #     lines = markup.splitlines(True)
-    #     for l in lines:
-    #         style = l[0]
-    #         justification = l[1].upper()
-    #         text = l[3:]
-
-    #         if style == 'b':
-    #             self.bold()
-    #         elif style == 'u':
-    #            self.underline()
-    #         elif style == 'i':
-    #            self.inverse()
-    #         elif style == 'f':
-    #             self.font_b()
-
-    #         self.justify(justification)
-    #         self.print_text(text)
-    #         if justification != 'L':
-    #             self.justify()
-
-    #         if style == 'b':
-    #             self.bold(False)
-    #         elif style == 'u':
-    #            self.underline(False)
-    #         elif style == 'i':
-    #            self.inverse(False)
-    #         elif style == 'f':
-    #             self.font_b(False)
+            data = str.encode("".join(l))
+        self.printer.write(data)
+        self.wait_for(data)
+
+    def print_markup(self, markup):
+        """ Print text with markup for styling.
+
+        Keyword arguments:
+        markup -- text with a left column of markup as follows:
+        first character denotes style (n=normal, b=bold, u=underline, i=inverse, f=font B)
+        second character denotes justification (l=left, c=centre, r=right)
+        third character must be a space, followed by the text of the line.
+        Shorter lines, e.g. empty ones, print as empty lines.
+        """
+        lines = markup.splitlines()
+        for l in lines:
+            if len(l) < 3:
+                self.print()
+                continue
+            style = l[0]
+            justification = l[1].upper()
+            text = l[3:]
+
+            if style == 'b':
+                self.bold()
+            elif style == 'u':
+                self.underline()
+            elif style == 'i':
+                self.reverse()
+            elif style == 'f':
+                self.alt_font()
+
+            self.justify(justification)
+            self.print(text)
+            if justification != 'L':
+                self.justify()
+
+            if style == 'b':
+                self.bold(False)
+            elif style == 'u':
+                self.underline(False)
+            elif style == 'i':
+                self.reverse(False)
+            elif style == 'f':
+                self.alt_font(False)
 
 
 if __name__ == '__main__':
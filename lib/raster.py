@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+    Bitmap conversion shared by the printer drivers.
+
+    pack() turns an image into packed dot lines: DOTS_PER_LINE / 8 bytes per
+    line, leftmost dot in the MSB, 1 prints a dot. Each driver frames those
+    lines with its own graphic commands (see render_bitmap()).
+
+    Accepted images, fastest first:
+    - PIL images in any mode, "1" is used as is without thresholding
+    - NumPy arrays of uint8 or bool, h x w, h x w x channels or flat,
+      thresholded by NumPy
+    - anything else supporting the buffer protocol (bytes, bytearray,
+      memoryview, array.array): one channel, RGB or RGBA, row after row
+    - the old plain list from Image.getdata(), one value or tuple per pixel
+
+    Only the list format costs a Python object per pixel. Everything else is
+    thresholded a row at a time with bytes.translate() and packed with int().
+
+    prepare() brings images of any size to the printer width first: fit
+    (shrink wider images), scale (to exactly the width) or crop (the middle
+    columns), optionally with Floyd-Steinberg dithering for photos. Shrinking
+    is area averaging done by PIL while it reads the source (JPEG files are
+    already reduced by the decoder), so only the printer sized result is ever
+    held in memory, and that is what gets thresholded or dithered.
+"""
+
+DOTS_PER_LINE = 384
+
+
+def _is_image(pixels):
+    return hasattr(pixels, 'mode') and hasattr(pixels, 'tobytes')
+
+
+def _is_array(pixels):
+    return hasattr(pixels, '__array_interface__') and hasattr(pixels, 'ndim')
+
+
+def _check_dtype(a):
+    if a.dtype.kind != 'b' and a.dtype.name != 'uint8':
+        raise Exception("ERROR: Unsupported array dtype %s. Please send uint8 (0-255) or bool" % a.dtype)
+
+
+def size(pixels):
+    """ (w, h) of a PIL image or a 2/3 dimensional NumPy array, None for anything else. """
+    if _is_image(pixels):
+        return pixels.size
+    if _is_array(pixels) and pixels.ndim in (2, 3):
+        return pixels.shape[1], pixels.shape[0]
+    return None
+
+
+def band(pixels, w, h, y0, y1):
+    """ Dot lines y0 to y1 of an image, in a form that can be sent to another process. """
+    if _is_image(pixels):
+        return pixels.crop((0, y0, w, y1))
+    if _is_array(pixels) and pixels.ndim > 1:
+        return pixels[y0:y1]
+    if isinstance(pixels, list):
+        return pixels[y0 * w:y1 * w]
+
+    data = memoryview(pixels)
+    if data.ndim != 1 or data.format != 'B':
+        data = data.cast('B') if data.c_contiguous else memoryview(data.tobytes())
+    row = len(data) // h
+    return data[y0 * row:y1 * row].tobytes()
+
+
+def _table(test):
+    """ bytes.translate() table, '1' for the byte values passing test, '0' for the rest. """
+    return bytes(0x31 if test(v) else 0x30 for v in range(256))
+
+
+def _gray_lines(gray, w, h, black_threshold, alpha=None, alpha_threshold=127):
+    """ One int per dot line from 8 bit single channel rows, bit set for each black dot. """
+    dark = _table(lambda v: v < black_threshold)
+    opaque = _table(lambda v: v > alpha_threshold)
+    gray = memoryview(gray)
+    for y in range(h):
+        line = int(gray[y * w:(y + 1) * w].tobytes().translate(dark), 2)
+        if alpha is not None:
+            line &= int(alpha[y * w:(y + 1) * w].translate(opaque), 2)
+        yield line
+
+
+def _image_lines(img, black_threshold, alpha_threshold):
+    w, h = img.size
+
+    if img.mode == '1':
+        # already packed, 1 is white
+        data = img.tobytes()
+        stride = (w + 7) // 8
+        white = (1 << w) - 1
+        for y in range(h):
+            yield (int.from_bytes(data[y * stride:(y + 1) * stride], 'big') >> (stride * 8 - w)) ^ white
+        return
+
+    alpha = None
+    if img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info:
+        img = img.convert('RGBA')
+        alpha = img.getchannel('A').tobytes()
+
+    if img.mode != 'L':
+        # plain average of the channels like the list format. PIL rounds the
+        # result, the -1/3 offset makes "L < threshold" exactly "R + G + B < 3 * threshold"
+        img = img.convert('RGB').convert('L', (1 / 3.0, 1 / 3.0, 1 / 3.0, -1 / 3.0))
+
+    for line in _gray_lines(img.tobytes(), w, h, black_threshold, alpha, alpha_threshold):
+        yield line
+
+
+def _buffer_lines(pixels, w, h, black_threshold, alpha_threshold):
+    data = memoryview(pixels)
+    if data.ndim != 1 or data.format != 'B':
+        data = data.cast('B') if data.c_contiguous else memoryview(data.tobytes())
+
+    channels = len(data) // (w * h)
+    if channels == 1:
+        return _gray_lines(data, w, h, black_threshold)
+    if channels not in (3, 4):
+        raise Exception("ERROR: Unsupported buffer: %s bytes for %sx%s pixels. Please send single channel, RGB or RGBA" % (len(data), w, h))
+
+    try:
+        from PIL import Image
+    except ImportError:
+        return _slow_buffer_lines(data, w, h, channels, black_threshold, alpha_threshold)
+
+    mode = 'RGB' if channels == 3 else 'RGBA'
+    img = Image.frombuffer(mode, (w, h), data, 'raw', mode, 0, 1)
+    return _image_lines(img, black_threshold, alpha_threshold)
+
+
+def _slow_buffer_lines(data, w, h, channels, black_threshold, alpha_threshold):
+    """ RGB(A) buffers without PIL, ints straight from the buffer. """
+    row = w * channels
+    for y in range(h):
+        p = data[y * row:(y + 1) * row]
+        line = 0
+        for i in range(0, row, channels):
+            line <<= 1
+            if p[i] + p[i + 1] + p[i + 2] < black_threshold * 3 and (channels == 3 or p[i + 3] > alpha_threshold):
+                line |= 1
+        yield line
+
+
+def _pack_array(a, w, h, black_threshold, alpha_threshold, width):
+    import numpy
+
+    a = numpy.asarray(a)
+    _check_dtype(a)
+    if a.ndim != 3:
+        a = a.reshape(h, w, -1)
+    channels = a.shape[2]
+    if channels not in (1, 3, 4):
+        raise Exception("ERROR: Unsupported array shape %s. Please send single channel, RGB or RGBA" % (a.shape,))
+
+    if a.dtype == bool:
+        # like PIL "1" mode, True is white
+        dark = ~a[:, :, 0]
+    else:
+        dark = a[:, :, :3].sum(axis=2, dtype=numpy.uint16) < black_threshold * min(channels, 3)
+        if channels == 4:
+            dark &= a[:, :, 3] > alpha_threshold
+
+    lines = numpy.zeros((h, width), dtype=bool)
+    lines[:, :w] = dark
+    return numpy.packbits(lines, axis=1).tobytes()
+
+
+def _pack_list(pixels, w, h, black_threshold, alpha_threshold, width):
+    line_bytes = width // 8
+    packed = bytearray(line_bytes * h)
+
+    first = pixels[0]
+    if type(first) == int: # single channel
+        dark = lambda p: p < black_threshold
+    elif type(first) in (list, tuple) and len(first) == 3: # RGB
+        dark = lambda p: p[0] + p[1] + p[2] < black_threshold * 3
+    elif type(first) in (list, tuple) and len(first) == 4: # RGBA
+        dark = lambda p: p[0] + p[1] + p[2] < black_threshold * 3 and p[3] > alpha_threshold
+    else:
+        raise Exception("ERROR: Unsupported pixels array type %s. Please send plain list (single channel, RGB or RGBA)" % type(first))
+
+    for i, p in enumerate(pixels):
+        if dark(p):
+            y, x = divmod(i, w)
+            packed[y * line_bytes + (x >> 3)] |= 0x80 >> (x & 7)
+
+    return bytes(packed)
+
+
+def _to_image(pixels, w, h):
+    """ PIL image over the same memory where possible. """
+    from PIL import Image
+
+    if _is_image(pixels):
+        return pixels
+    if _is_array(pixels):
+        import numpy
+        a = numpy.asarray(pixels)
+        _check_dtype(a)
+        if a.ndim != 3:
+            a = a.reshape(h, w, -1)
+        return Image.fromarray(a[:, :, 0] if a.shape[2] == 1 else a)
+    if isinstance(pixels, (list, tuple)):
+        first = pixels[0]
+        mode = 'L' if type(first) == int else 'RGB' if len(first) == 3 else 'RGBA'
+        img = Image.new(mode, (w, h))
+        img.putdata(pixels)
+        return img
+
+    data = memoryview(pixels)
+    if data.ndim != 1 or data.format != 'B':
+        data = data.cast('B') if data.c_contiguous else memoryview(data.tobytes())
+    mode = {1: 'L', 3: 'RGB', 4: 'RGBA'}.get(len(data) // (w * h))
+    if mode is None:
+        raise Exception("ERROR: Unsupported buffer: %s bytes for %sx%s pixels. Please send single channel, RGB or RGBA" % (len(data), w, h))
+    return Image.frombuffer(mode, (w, h), data, 'raw', mode, 0, 1)
+
+
+def _draft(img, size):
+    """ A JPEG not decoded yet, opened again and decoded at 1/2, 1/4 or 1/8 scale,
+        still at least size. The caller's image is left as it is. """
+    if img.format != 'JPEG' or not getattr(img, 'tile', None):
+        return img
+
+    from PIL import Image
+    source = getattr(img, 'filename', None) or img.fp
+    position = None if isinstance(source, str) else source.tell()
+    try:
+        reduced = Image.open(source)
+        reduced.draft(img.mode, size)
+        reduced.load()
+        return reduced
+    except (OSError, ValueError):
+        return img
+    finally:
+        if position is not None:
+            source.seek(position)
+
+
+def prepare(pixels, w=None, h=None, width=DOTS_PER_LINE, fit='fit', dither=False, alpha_threshold=127):
+    """ Bring an image to at most width dots, returns (pixels, w, h) for pack().
+
+        fit = 'fit' shrinks wider images to width, 'scale' scales any image to width,
+              'crop' keeps the middle width columns
+        dither = Floyd-Steinberg instead of the black threshold, for photos
+
+        Images that already fit are returned as they are unless dithered, so
+        they print exactly as before.
+    """
+    if w is None or h is None:
+        if size(pixels) is None:
+            raise Exception("ERROR: w and h are required for buffers and plain lists")
+        w, h = size(pixels)
+    if fit not in ('fit', 'scale', 'crop'):
+        raise Exception("ERROR: Unknown fit: %s. Please use fit, scale or crop" % fit)
+
+    if fit == 'crop' or w <= width and fit == 'fit':
+        tw, th = min(w, width), h
+    else:
+        tw, th = width, max(1, int(round(h * width / float(w))))
+    if (tw, th) == (w, h) and not dither:
+        return pixels, w, h
+
+    from PIL import Image
+    img = _to_image(pixels, w, h)
+
+    if (tw, th) != (w, h) and fit != 'crop':
+        img = _draft(img, (tw, th))
+
+    if img.mode not in ('L', 'LA', 'RGB', 'RGBA'):
+        img = img.convert('RGBA' if img.mode in ('P', 'PA') or 'transparency' in img.info else 'L')
+
+    # the region to keep, in the (possibly drafted) image coordinates
+    sx, sy = img.size[0] / float(w), img.size[1] / float(h)
+    x0 = (w - tw) // 2 if fit == 'crop' else 0
+    box = (x0 * sx, 0, (x0 + (tw if fit == 'crop' else w)) * sx, h * sy)
+
+    if img.size != (tw, th) or box != (0, 0) + img.size:
+        # area average, integer reductions first
+        img = img.resize((tw, th), Image.BOX, box=box, reducing_gap=2.0)
+
+    if not dither:
+        return img, tw, th
+
+    if img.mode in ('LA', 'RGBA'):
+        # transparent is white
+        alpha = img.getchannel('A').point(lambda a: 255 if a <= alpha_threshold else 0)
+        img = img.convert('L')
+        img.paste(255, mask=alpha)
+    elif img.mode != 'L':
+        img = img.convert('L')
+    return img.convert('1', dither=Image.FLOYDSTEINBERG), tw, th
+
+
+def pack(pixels, w, h, black_threshold=48, alpha_threshold=127, width=DOTS_PER_LINE):
+    """ Threshold an image into packed dot lines, padded with white up to width.
+
+        pixels = PIL image, NumPy array, buffer or plain list, see above
+        Pixels darker than black_threshold (average of the colour channels) print,
+        unless their alpha is below alpha_threshold.
+    """
+    if w > width:
+        raise Exception("ERROR: Bitmap width too large: %s. Needs to be under %s" % (w, width))
+
+    line_bytes = width // 8
+    if not w or not h:
+        return bytes(line_bytes * h)
+
+    if _is_image(pixels):
+        lines = _image_lines(pixels, black_threshold, alpha_threshold)
+    elif _is_array(pixels):
+        return _pack_array(pixels, w, h, black_threshold, alpha_threshold, width)
+    elif isinstance(pixels, (list, tuple)):
+        return _pack_list(pixels, w, h, black_threshold, alpha_threshold, width)
+    else:
+        lines = _buffer_lines(pixels, w, h, black_threshold, alpha_threshold)
+
+    return b"".join((line << (width - w)).to_bytes(line_bytes, 'big') for line in lines)
@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+    Print server: text, markup and image jobs over HTTP on localhost, for
+    front ends that can't open the serial port themselves.
+
+        python -m lib.server
+        python -m lib.server --listen 127.0.0.1:8040 --printer portipc40:/dev/ttyUSB0
+        python -m lib.server --printer kitchen=dpt100s:/dev/ttyUSB0 --printer bar=portipc40:/dev/ttyUSB1
+
+    Requests:
+
+        POST /print/text       body is the text, UTF-8
+        POST /print/markup     body is print_markup() markup
+        POST /print/image      body is an image file (PNG, JPEG...)
+        POST /print            body is a lib.batch JSON job: text, markup, barcode, qr or feed,
+                               within JSON_LIMITS (feed, barcode height)
+        GET  /jobs/<id>        job status
+        GET  /status           queue depth and counters of every printer
+
+    Query parameters for POST: printer=<name> (the first one by default),
+    coalesce=0 to send the job on its own, wait=1 to answer only once it is
+    printed. The answer is the job status:
+
+        {"id": 12, "printer": "default", "status": "queued", "eta": 1.4}
+
+    status goes queued, printing, then done or failed (with "error").
+
+    Each printer is opened and reset once, when the server starts, and a
+    single thread writes to it. Jobs are rendered to bytes in the request
+    threads. Small text and markup jobs waiting in the queue are sent together
+    in one write, up to COALESCE_BYTES. Other jobs, and jobs posted with
+    coalesce=0, always go out alone. Jobs are sent through lib/transport.py,
+    a stalled port is reopened and the job resumed (--retries).
+"""
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from threading import Thread, Condition
+from collections import OrderedDict, deque
+from itertools import count
+from lib.jobs import MODELS, job_kind, run_job
+from io import BytesIO
+from time import time
+import argparse
+import json
+import sys
+
+
+# jobs of at most this many rendered bytes can be coalesced
+SMALL_JOB = 512
+# up to this many bytes per coalesced write
+COALESCE_BYTES = 2048
+# queued jobs per printer before requests are refused
+MAX_QUEUE = 1000
+# finished jobs whose status can still be looked up
+KEEP_JOBS = 1000
+# largest request body
+MAX_BODY = 16 * 1024 * 1024
+
+# JSON jobs accepted by POST /print. Not the ones naming files on this host.
+JSON_JOBS = ('text', 'markup', 'barcode', 'qr', 'feed')
+# largest numbers in them: lines fed, barcode height in dot lines
+JSON_LIMITS = {'feed': 50, 'height': 255}
+
+_ids = count(1)
+
+
+class Job(object):
+
+    def __init__(self, printer, data, coalesce, seconds):
+        self.id = next(_ids)
+        self.printer = printer
+        self.data = data
+        self.coalesce = coalesce and len(data) <= SMALL_JOB
+        self.seconds = seconds
+        self.status = 'queued'
+        self.error = None
+        self.created = time()
+        self.finished = None
+
+    def state(self, eta=None):
+        state = {'id': self.id, 'printer': self.printer, 'status': self.status}
+        if eta is not None:
+            state['eta'] = round(eta, 2)
+        if self.error is not None:
+            state['error'] = self.error
+        if self.finished is not None:
+            state['seconds'] = round(self.finished - self.created, 2)
+        return state
+
+
+class PrintQueue(object):
+    """
+        One printer and the thread writing to it.
+
+        name = printer name in requests and job status
+        printer = an open ThermalPrinter, kept for the life of the queue
+    """
+
+    def __init__(self, name, printer):
+        self.name = name
+        self.printer = printer
+        if printer.cost is None:
+            from lib.costmodel import CostModel
+            printer.cost = CostModel(type(printer))
+
+        self.queue = deque()
+        self.jobs = OrderedDict()
+        self.changed = Condition()
+        self.busy_until = 0.0
+        self.counters = {'done': 0, 'failed': 0, 'writes': 0, 'bytes': 0}
+
+        self.writer = Thread(target=self._write, daemon=True)
+        self.writer.start()
+
+    def render(self, kind, body):
+        """ Printer bytes for a request, rendered by a recording driver of the same model. """
+        p = type(self.printer)(printer=BytesIO())
+        if kind == 'image':
+            from PIL import Image
+            p.print_bitmap(Image.open(BytesIO(body)))
+            return p.printer.getvalue()
+
+        if kind == 'json':
+            job = json.loads(body.decode('utf-8'))
+            if job_kind(job) not in JSON_JOBS:
+                raise Exception("ERROR: Job must be one of: %s" % ", ".join(JSON_JOBS))
+            for key, limit in JSON_LIMITS.items():
+                if key in job and not (type(job[key]) == int and 0 <= job[key] <= limit):
+                    raise Exception("ERROR: %s must be a whole number from 0 to %s" % (key, limit))
+        else:
+            job = {kind: body.decode('utf-8')}
+
+        run_job(p, job, '.')
+        return p.printer.getvalue()
+
+    def submit(self, kind, body, coalesce=True):
+        data = self.render(kind, body)
+        job = Job(self.name, data, coalesce and kind in ('text', 'markup'), self.printer.cost.estimate(data))
+
+        with self.changed:
+            if len(self.queue) >= MAX_QUEUE:
+                raise OverflowError("ERROR: Print queue of %s is full" % self.name)
+            self.queue.append(job)
+            self.jobs[job.id] = job
+            self.changed.notify_all()
+        return job
+
+    def _next(self):
+        """ Wait for a job, take it with the small jobs right behind it. """
+        with self.changed:
+            while not self.queue:
+                self.changed.wait()
+
+            batch = [self.queue.popleft()]
+            size = len(batch[0].data)
+            while batch[0].coalesce and self.queue and self.queue[0].coalesce \
+                    and size + len(self.queue[0].data) <= COALESCE_BYTES:
+                batch.append(self.queue.popleft())
+                size += len(batch[-1].data)
+
+            for job in batch:
+                job.status = 'printing'
+            self.busy_until = time() + sum(job.seconds for job in batch)
+            return batch
+
+    def _write(self):
+        p = self.printer
+        while True:
+            batch = self._next()
+            data = b"".join(job.data for job in batch)
+            try:
+                p.send(data)
+                if hasattr(p.printer, 'flush'):
+                    p.printer.flush()
+                p.wait_for(data)
+                status, error = 'done', None
+            except Exception as e:
+                status, error = 'failed', str(e)
+
+            with self.changed:
+                for job in batch:
+                    job.status, job.error, job.finished = status, error, time()
+                    job.data = None
+                self.counters[status] += len(batch)
+                self.counters['writes'] += 1
+                self.counters['bytes'] += len(data)
+                self.busy_until = 0.0
+
+                # forget the oldest finished jobs
+                finished = [i for i, job in self.jobs.items() if job.finished is not None]
+                for i in finished[:max(0, len(finished) - KEEP_JOBS)]:
+                    del self.jobs[i]
+                self.changed.notify_all()
+
+    def state(self, job):
+        """ Status of a job, with the model time left until it is printed. """
+        with self.changed:
+            if job.finished is not None:
+                return job.state()
+            eta = max(0.0, self.busy_until - time())
+            if job.status == 'queued':
+                for queued in self.queue:
+                    eta += queued.seconds
+                    if queued is job:
+                        break
+            return job.state(eta)
+
+    def wait(self, job, timeout=None):
+        with self.changed:
+            self.changed.wait_for(lambda: job.finished is not None, timeout)
+        return self.state(job)
+
+    def status(self):
+        with self.changed:
+            status = {
+                'model': type(self.printer).__module__,
+                'port': getattr(self.printer.printer, 'port', None),
+                'queued': len(self.queue),
+                'eta': round(max(0.0, self.busy_until - time()) + sum(job.seconds for job in self.queue), 2),
+            }
+            status.update(self.counters)
+            return status
+
+
+class PrintServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+    # listen backlog, bursts of front ends posting at once
+    request_queue_size = 128
+    verbose = False
+
+    def __init__(self, address, queues):
+        """ queues = PrintQueue list, the first one is the default printer """
+        self.queues = OrderedDict((q.name, q) for q in queues)
+        ThreadingHTTPServer.__init__(self, address, PrintHandler)
+
+    def job(self, job_id):
+        for q in self.queues.values():
+            # the writer thread drops old jobs under the same lock
+            with q.changed:
+                job = q.jobs.get(job_id)
+            if job is not None:
+                return q, job
+        return None, None
+
+
+class PrintHandler(BaseHTTPRequestHandler):
+
+    KINDS = {'/print/text': 'text', '/print/markup': 'markup', '/print/image': 'image', '/print': 'json'}
+
+    def reply(self, code, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        path = urlsplit(self.path).path.rstrip('/')
+        if path == '/status':
+            return self.reply(200, {name: q.status() for name, q in self.server.queues.items()})
+
+        if path.startswith('/jobs/') and path[6:].isdigit():
+            q, job = self.server.job(int(path[6:]))
+            if job is not None:
+                return self.reply(200, q.state(job))
+
+        self.reply(404, {'error': "Not found: %s" % path})
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        kind = self.KINDS.get(url.path.rstrip('/'))
+        if kind is None:
+            return self.reply(404, {'error': "Not found: %s" % url.path})
+
+        name = query.get('printer', [next(iter(self.server.queues))])[0]
+        q = self.server.queues.get(name)
+        if q is None:
+            return self.reply(404, {'error': "No printer named %s" % name})
+
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_BODY:
+            return self.reply(413, {'error': "Request body over %s bytes" % MAX_BODY})
+        body = self.rfile.read(length)
+
+        try:
+            job = q.submit(kind, body, coalesce=query.get('coalesce', ['1'])[0] != '0')
+        except OverflowError as e:
+            return self.reply(503, {'error': str(e)})
+        except Exception as e:
+            return self.reply(400, {'error': str(e)})
+
+        if query.get('wait', ['0'])[0] != '0':
+            return self.reply(200, q.wait(job))
+        self.reply(202, q.state(job))
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+def open_printer(spec, retries=0):
+    """ 'name=model:port', 'model:port' or 'model' to (name, ThermalPrinter).
+        retries = reconnects in a row before a job fails, 0 for no resumable transport """
+    from importlib import import_module
+
+    name, _, spec = spec.rpartition('=')
+    model, _, port = spec.partition(':')
+    if model not in MODELS:
+        raise Exception("ERROR: Unknown printer model: %s" % model)
+
+    ThermalPrinter = import_module(MODELS[model]).ThermalPrinter
+    p = ThermalPrinter(serialport=port or ThermalPrinter.SERIALPORT)
+    if retries:
+        from lib.transport import Transport
+        Transport(p, retries=retries)
+    return name, p
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m lib.server', description="Print text, markup and images sent over HTTP.")
+    parser.add_argument('--listen', default='127.0.0.1:8040', metavar='HOST:PORT')
+    parser.add_argument('--printer', action='append', metavar='[NAME=]MODEL[:PORT]',
+                        help="printer to serve, repeat for more. portipc40 on its default port if not given")
+    parser.add_argument('--cost', metavar='FILE', help="calibrated CostModel for the first printer, see lib/costmodel.py")
+    parser.add_argument('--retries', type=int, default=3, metavar='N',
+                        help="reconnect and resume a job up to N times in a row when the port stalls, 0 to fail right away")
+    parser.add_argument('--verbose', action='store_true', help="log every request")
+    args = parser.parse_args(argv)
+
+    queues = []
+    for n, spec in enumerate(args.printer or ['portipc40']):
+        name, p = open_printer(spec, args.retries)
+        if n == 0 and args.cost:
+            from lib.costmodel import CostModel
+            p.cost = CostModel.load(type(p), args.cost)
+        queues.append(PrintQueue(name or ('default' if n == 0 else str(n)), p))
+
+    host, _, port = args.listen.rpartition(':')
+    server = PrintServer((host or '127.0.0.1', int(port)), queues)
+    server.verbose = args.verbose
+    print("Serving %s on http://%s:%s" % (", ".join(server.queues), host or '127.0.0.1', port), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
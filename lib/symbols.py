@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+    Raster fallback for symbols the printer firmware can't draw by itself.
+
+    Both drivers send linear barcodes with their own firmware commands, which
+    costs a few tens of bytes on the wire. Whatever a model lacks (QR codes on
+    both, PDF417, CODE93 and CODE128 on the DPT100-S, GS1-128...) is rendered
+    here into a single channel image, returned as (pixels, w, h) ready for
+    print_bitmap().
+
+    Runtime dependencies are optional and only imported when needed:
+    qrcode for QR, pdf417gen for PDF417, python-barcode (with PIL) for the rest.
+"""
+
+DOTS_PER_LINE = 384
+
+# 8 dots/mm on both printers
+DOTS_PER_MM = 8.0
+
+
+def _check_width(w, max_width):
+    if w > max_width:
+        raise Exception("ERROR: Symbol is %s dots wide, printer line is only %s" % (w, max_width))
+
+
+def _matrix_to_pixels(matrix, module, max_width):
+    """ Scale a matrix of booleans (True = dark) into single channel pixel bytes. """
+    cols = len(matrix[0])
+    if not module:
+        module = max(1, min(8, max_width // cols))
+    w = cols * module
+    _check_width(w, max_width)
+
+    pixels = bytearray()
+    for row in matrix:
+        line = b"".join(b'\x00' * module if dark else b'\xff' * module for dark in row)
+        pixels += line * module
+
+    return bytes(pixels), w, len(matrix) * module
+
+
+def _image_to_pixels(img, max_width):
+    img = img.convert('L')
+    w, h = img.size
+    _check_width(w, max_width)
+    return img, w, h
+
+
+def qr(data, module=None, ec='M', max_width=DOTS_PER_LINE):
+    """ QR code as (pixels, w, h). module = dots per module, largest that fits if not set. """
+    import qrcode
+
+    levels = {
+        'L': qrcode.constants.ERROR_CORRECT_L,
+        'M': qrcode.constants.ERROR_CORRECT_M,
+        'Q': qrcode.constants.ERROR_CORRECT_Q,
+        'H': qrcode.constants.ERROR_CORRECT_H,
+    }
+    code = qrcode.QRCode(error_correction=levels[ec.upper()], border=4)
+    code.add_data(data)
+    code.make(fit=True)
+
+    return _matrix_to_pixels(code.get_matrix(), module, max_width)
+
+
+def pdf417(data, columns=4, security_level=2, module=2, ratio=3, max_width=DOTS_PER_LINE):
+    """ PDF417 as (pixels, w, h), for models without a native 2D command. """
+    import pdf417gen
+
+    codes = pdf417gen.encode(data, columns=columns, security_level=security_level)
+    img = pdf417gen.render_image(codes, scale=module, ratio=ratio, padding=2 * module)
+
+    return _image_to_pixels(img, max_width)
+
+
+def barcode(code, data, height=80, module=2, max_width=DOTS_PER_LINE):
+    """ Linear barcode as (pixels, w, h).
+
+        code = any symbology known to python-barcode (CODE128, GS1_128, ...)
+        height = bar height in dot lines
+        module = width of the narrowest bar in dots
+    """
+    import barcode as pybarcode
+    from barcode.writer import ImageWriter
+
+    symbol = pybarcode.get(code.lower(), data, writer=ImageWriter())
+    img = symbol.render({
+        'dpi': int(DOTS_PER_MM * 25.4),
+        'module_width': module / DOTS_PER_MM,
+        'module_height': height / DOTS_PER_MM,
+        'quiet_zone': 2.0,
+        'write_text': False,
+    })
+
+    return _image_to_pixels(img, max_width)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+    Resumable transmission: long jobs survive a stalled or unplugged serial
+    link without being sent again from the start.
+
+    Example:
+        from lib.portipc40 import ThermalPrinter
+        from lib.transport import Transport
+
+        p = ThermalPrinter()
+        Transport(p)          # from now on p.send() is resumable
+        p.print_bitmap(Image.open("long-receipt.png"))
+
+    send() writes in chunks of about CHUNK bytes, cut only where the driver's
+    scan() sees a dot line or a band end, so every chunk boundary is a point
+    the job can restart from. A checkpoint moves forward once the bytes before
+    it have left the serial port (out_waiting), not merely the write() call.
+
+    A write that times out (write_timeout), accepts fewer bytes than given,
+    or a port that stops draining for write_timeout counts as a stall. The
+    port is then closed and reopened, the printer gets the model's RESYNC
+    (NULs completing a command cut off halfway, then ESC @), RESYNC_DELAY
+    seconds to reset, and the print modes in effect at the checkpoint (size,
+    underline, justification...), and the job carries on from the checkpoint. At most the chunk in flight
+    is printed twice.
+
+    Everything the driver writes outside send() (text, style commands) goes
+    through the Transport too, so the modes it sets are replayed as well.
+"""
+
+from bisect import bisect_right
+from time import time, sleep
+
+
+class Stall(Exception):
+    """ The port took fewer bytes than given or stopped sending. """
+
+
+class Transport(object):
+    """
+        printer = an open ThermalPrinter on a serial port. The Transport attaches
+                  itself as printer.transport and wraps printer.printer.
+        chunk = bytes per write, rounded to the next checkpoint
+        write_timeout = seconds without progress counting as a stall, the driver's
+                        TIMEOUT plus the time to send a chunk if not set
+        retries = reconnects in a row without progress before giving up
+        retry_delay = seconds between closing and reopening the port
+    """
+
+    CHUNK = 1024
+    RETRIES = 5
+    # unparsed bytes from direct writes kept before their modes are folded in
+    PENDING = 4096
+
+    def __init__(self, printer, chunk=CHUNK, write_timeout=None, retries=RETRIES, retry_delay=1.0):
+        self.printer = printer
+        self.serial = printer.printer
+        self.chunk = chunk
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+        if write_timeout is None:
+            write_timeout = printer.TIMEOUT + chunk * 10.0 / printer.BAUDRATE
+        self.write_timeout = write_timeout
+        self.serial.write_timeout = write_timeout
+
+        # print modes set so far, and direct writes not scanned for them yet
+        self.modes = {}
+        self.pending = bytearray()
+        self.reconnects = 0
+
+        printer.printer = self
+        printer.transport = self
+
+    @property
+    def port(self):
+        return getattr(self.serial, 'port', None)
+
+    def _fold(self):
+        if self.pending:
+            type(self.printer).scan(bytes(self.pending), self.modes)
+            del self.pending[:]
+
+    def write(self, data):
+        """ Direct writes from the driver, checked but not resumable. """
+        self._write(data)
+        self.pending += data
+        # fold at a line end, where no command is left halfway
+        if len(self.pending) > self.PENDING and data[-1:] == b'\n':
+            self._fold()
+        return len(data)
+
+    def flush(self):
+        self._drain()
+
+    def close(self):
+        self.serial.close()
+
+    def _write(self, data):
+        n = self.serial.write(data)
+        if n is not None and n < len(data):
+            raise Stall("ERROR: Short write, %s of %s bytes" % (n, len(data)))
+
+    def _unsent(self):
+        return getattr(self.serial, 'out_waiting', 0) or 0
+
+    def _drain(self, progress=None):
+        """ Wait until the port has sent everything, Stall if it stops moving. """
+        left, moved = self._unsent(), time()
+        while left:
+            sleep(0.01)
+            now = self._unsent()
+            if now < left:
+                left, moved = now, time()
+                if progress is not None:
+                    progress()
+            elif time() - moved > self.write_timeout:
+                raise Stall("ERROR: Serial port stopped sending, %s bytes left" % left)
+
+    def _reconnect(self):
+        try:
+            self.serial.close()
+        except Exception:
+            pass
+        sleep(self.retry_delay)
+        self.serial.open()
+        self.reconnects += 1
+
+    def send(self, data, progress=None):
+        """ Write rendered bytes, resuming from the last checkpoint after a stall.
+            progress = called with the last checkpoint sent as it moves forward """
+        data = bytes(data)
+        self._fold()
+        ThermalPrinter = type(self.printer)
+
+        modes = dict(self.modes)
+        checkpoints = [end for end, _ in ThermalPrinter.scan(data, modes)]
+        if not checkpoints or checkpoints[-1] != len(data):
+            checkpoints.append(len(data))
+
+        # last checkpoint known to have left the port
+        self.done = 0
+        stalls = failures = 0
+        while True:
+            start = self.done
+            try:
+                if stalls:
+                    state = dict(self.modes)
+                    ThermalPrinter.scan(data[:self.done], state)
+                    # bytes arriving while the printer resets are lost
+                    self._write(ThermalPrinter.RESYNC)
+                    self._drain()
+                    self.printer.pause(ThermalPrinter.RESYNC_DELAY)
+                    if state:
+                        self._write(b"".join(state.values()))
+                self._send(data, checkpoints, progress)
+                break
+            except (Stall, OSError) as e: # SerialException is an OSError
+                stalls += 1
+                failures = 0 if self.done > start else failures + 1
+                if failures > self.retries:
+                    raise Exception("ERROR: Giving up after %s reconnects, %s of %s bytes sent: %s" % (self.retries, self.done, len(data), e))
+                try:
+                    self._reconnect()
+                except OSError:
+                    pass # still gone, the next write fails and counts
+
+        self.modes = modes
+
+    def _send(self, data, checkpoints, progress=None):
+        sent = self.done
+
+        def confirm():
+            # what has left the port is safe
+            k = bisect_right(checkpoints, sent - self._unsent()) - 1
+            if k >= 0 and checkpoints[k] > self.done:
+                self.done = checkpoints[k]
+                if progress is not None:
+                    progress(self.done)
+
+        while sent < len(data):
+            # the last checkpoint within a chunk, or the first one past it
+            k = bisect_right(checkpoints, sent + self.chunk) - 1
+            end = checkpoints[k] if k >= 0 and checkpoints[k] > sent else checkpoints[k + 1]
+
+            self._write(data[sent:end])
+            sent = end
+            confirm()
+
+        self._drain(confirm)
+        if self.done < len(data):
+            self.done = len(data)
+            if progress is not None:
+                progress(self.done)
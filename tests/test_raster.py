@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+    lib/raster.py: every accepted pixel format prints the same bytes.
+
+        python -m unittest tests.test_raster
+"""
+
+from PIL import Image, ImageDraw
+from io import BytesIO
+import unittest
+import numpy
+
+from lib import dpt100s, portipc40, raster
+
+
+def picture(mode, w=200, h=50):
+    """ Gradient with shapes and, for RGBA, a transparent stripe. """
+    img = Image.linear_gradient('L').resize((w, h)).convert('RGBA')
+    draw = ImageDraw.Draw(img)
+    draw.ellipse((10, 5, 90, 45), fill=(200, 20, 20, 255))
+    draw.rectangle((120, 10, 180, 40), fill=(10, 10, 10, 255))
+    draw.rectangle((0, 20, w, 30), fill=(0, 0, 0, 60))
+    return img.convert(mode)
+
+
+class RasterTest(unittest.TestCase):
+
+    MODELS = (portipc40.ThermalPrinter, dpt100s.ThermalPrinter)
+
+    def formats(self, img):
+        """ The same image as a PIL image, a plain list, a buffer and NumPy arrays. """
+        w, h = img.size
+        # 1 bit images as buffers and lists are 0 / 255 values
+        flat = img.convert('L') if img.mode == '1' else img
+        yield 'image', img, None, None
+        yield 'list', list(flat.getdata()), w, h
+        yield 'bytes', flat.tobytes(), w, h
+        yield 'memoryview', memoryview(bytearray(flat.tobytes())), w, h
+        yield 'array', numpy.asarray(img), None, None
+        yield 'flat array', numpy.asarray(img).ravel(), w, h
+
+    def test_pack_identical(self):
+        for mode in ('L', 'RGB', 'RGBA', '1'):
+            img = picture(mode)
+            expected = raster.pack(img, *img.size)
+            self.assertNotEqual(expected, bytes(len(expected)))
+            for name, pixels, w, h in self.formats(img):
+                with self.subTest(mode=mode, format=name):
+                    self.assertEqual(raster.pack(pixels, *img.size), expected)
+
+    def test_print_bitmap_identical(self):
+        """ through prepare(), scaled down from wider than the printer """
+        for ThermalPrinter in self.MODELS:
+            for mode in ('L', 'RGB', 'RGBA', '1'):
+                for width in (200, 500):
+                    img = picture(mode, w=width)
+                    expected = None
+                    for name, pixels, w, h in self.formats(img):
+                        with self.subTest(model=ThermalPrinter.__module__, mode=mode, width=width, format=name):
+                            p = ThermalPrinter(printer=BytesIO())
+                            p.print_bitmap(pixels, w, h)
+                            if expected is None:
+                                expected = p.printer.getvalue()
+                            self.assertEqual(p.printer.getvalue(), expected)
+
+    def test_buffer_without_size(self):
+        for pixels in (bytes(100), [0] * 100, numpy.zeros(100, numpy.uint8)):
+            with self.assertRaisesRegex(Exception, "w and h are required"):
+                portipc40.ThermalPrinter(printer=BytesIO()).print_bitmap(pixels)
+
+    def test_array_dtype(self):
+        white = numpy.ones((24, 100), numpy.float32)
+        with self.assertRaisesRegex(Exception, "dtype float32"):
+            raster.pack(white, 100, 24)
+        with self.assertRaisesRegex(Exception, "dtype float32"):
+            raster.prepare(white, 100, 24, dither=True)
+
+        # bool is like PIL "1", True is white
+        self.assertEqual(raster.pack(numpy.ones((24, 100), bool), 100, 24), bytes(48 * 24))
+
+
+if __name__ == '__main__':
+    unittest.main()
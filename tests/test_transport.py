@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+    lib/transport.py against a fake serial port that fails halfway through a
+    write: the job resumes from the last checkpoint after RESYNC, the reset
+    pause and the saved print modes.
+
+        python -m unittest tests.test_transport
+"""
+
+from serial import SerialTimeoutException
+from PIL import Image
+from io import BytesIO
+import unittest
+
+from lib import dpt100s, portipc40
+from lib.transport import Transport
+
+
+class FakePort(object):
+    """ Takes everything, except the writes numbered in cut (counted from arm()),
+        which get only half their bytes, or raise with timeout=True. """
+
+    def __init__(self):
+        self.writes = []
+        self.pauses = []
+        self.opened = 0
+        self.out_waiting = 0
+        self.cut = ()
+
+    def arm(self, cut, timeout=False):
+        self.writes = []
+        self.cut, self.timeout = cut, timeout
+
+    def write(self, data):
+        data = bytes(data)
+        if len(self.writes) + 1 not in self.cut:
+            self.writes.append(data)
+            return len(data)
+
+        self.writes.append(data[:len(data) // 2])
+        if self.timeout:
+            raise SerialTimeoutException("Write timeout")
+        return len(data) // 2
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def open(self):
+        self.opened += 1
+
+
+def recorded(ThermalPrinter, job):
+    r = ThermalPrinter(printer=BytesIO())
+    job(r)
+    return r.printer.getvalue()
+
+
+class TransportTest(unittest.TestCase):
+
+    MODELS = (portipc40.ThermalPrinter, dpt100s.ThermalPrinter)
+    # a print mode set by a direct write before the job
+    BIG = {
+        portipc40.ThermalPrinter: lambda r: r.size(2, 2),
+        dpt100s.ThermalPrinter: lambda r: r.d_width(),
+    }
+
+    def printer(self, ThermalPrinter):
+        port = FakePort()
+        p = ThermalPrinter(printer=port)
+        # a pause shows up in the byte stream as the number of writes before it
+        p.pause = lambda seconds: port.pauses.append((len(port.writes), seconds))
+        t = Transport(p, chunk=256, retry_delay=0)
+        return p, t, port
+
+    def job(self, ThermalPrinter):
+        def job(r):
+            r.underline()
+            r.print("before the picture")
+            r.print_bitmap(Image.linear_gradient('L').resize((384, 120)))
+            r.print("after the picture")
+        return recorded(ThermalPrinter, job)
+
+    def check_resumed(self, ThermalPrinter, timeout):
+        p, t, port = self.printer(ThermalPrinter)
+        big = recorded(ThermalPrinter, self.BIG[ThermalPrinter])
+        underline = recorded(ThermalPrinter, lambda r: r.underline())
+        self.BIG[ThermalPrinter](p)
+
+        data = self.job(ThermalPrinter)
+        port.arm((3,), timeout)
+        sent = []
+        p.send(data, sent.append)
+
+        w = port.writes
+        resume = len(w[0]) + len(w[1])
+        self.assertEqual(w[0] + w[1], data[:resume])
+        self.assertEqual(w[2], data[resume:resume + len(w[2])])
+
+        # reset, wait for it, then the modes, then the job from the checkpoint
+        self.assertEqual(w[3], ThermalPrinter.RESYNC)
+        self.assertEqual(port.pauses, [(4, ThermalPrinter.RESYNC_DELAY)])
+        self.assertEqual(w[4], big + underline)
+        self.assertEqual(b"".join(w[5:]), data[resume:])
+
+        self.assertEqual((t.reconnects, port.opened), (1, 1))
+        self.assertEqual(sent, sorted(sent))
+        self.assertEqual(sent[-1], len(data))
+
+    def test_short_write(self):
+        for ThermalPrinter in self.MODELS:
+            with self.subTest(ThermalPrinter.__module__):
+                self.check_resumed(ThermalPrinter, timeout=False)
+
+    def test_write_timeout(self):
+        for ThermalPrinter in self.MODELS:
+            with self.subTest(ThermalPrinter.__module__):
+                self.check_resumed(ThermalPrinter, timeout=True)
+
+    def test_checkpoints(self):
+        """ every write ends where scan() sees a dot line or a band end """
+        for ThermalPrinter in self.MODELS:
+            with self.subTest(ThermalPrinter.__module__):
+                p, t, port = self.printer(ThermalPrinter)
+                data = self.job(ThermalPrinter)
+                port.arm(())
+                p.send(data)
+
+                ends = {end for end, _ in ThermalPrinter.scan(data)}
+                offset = 0
+                for chunk in port.writes[:-1]:
+                    offset += len(chunk)
+                    self.assertIn(offset, ends)
+                self.assertEqual(b"".join(port.writes), data)
+                self.assertEqual(t.reconnects, 0)
+
+    def test_no_progress_gives_up(self):
+        p, t, port = self.printer(portipc40.ThermalPrinter)
+        data = self.job(portipc40.ThermalPrinter)
+        port.arm(range(1, 100))
+
+        with self.assertRaisesRegex(Exception, "Giving up after %s reconnects" % t.retries):
+            p.send(data)
+        self.assertEqual(t.reconnects, t.retries)
+
+    def test_progress_resets_retries(self):
+        """ failures only count in a row, a job that moves forward keeps going """
+        p, t, port = self.printer(portipc40.ThermalPrinter)
+        t.retries = 1
+        data = self.job(portipc40.ThermalPrinter)
+        # after each reconnect: RESYNC, the modes, a chunk that goes through, a cut one
+        port.arm(range(4, 1000, 4))
+
+        p.send(data)
+        self.assertGreater(t.reconnects, t.retries)
+        self.assertTrue(data.endswith(port.writes[-1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
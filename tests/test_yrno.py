@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+    applications/yr.no.py against a local stand-in for yr.no serving
+    tests/forecast.xml, with ETag / 304 handling.
+
+        python -m unittest tests.test_yrno
+"""
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from importlib.util import spec_from_file_location, module_from_spec
+from threading import Thread
+from base64 import b64decode
+import tempfile
+import unittest
+import os
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+with open(os.path.join(HERE, 'forecast.xml'), 'rb') as f:
+    FORECAST = f.read()
+
+ETAG = '"forecast-1"'
+
+
+def load_app():
+    """ applications/yr.no.py, its name isn't importable """
+    spec = spec_from_file_location('yrno', os.path.join(HERE, '..', 'applications', 'yr.no.py'))
+    app = module_from_spec(spec)
+    spec.loader.exec_module(app)
+    return app
+
+
+class StandIn(BaseHTTPRequestHandler):
+
+    # what GET /forecast.xml answers, set by the tests
+    body = FORECAST
+    requests = []
+
+    def do_GET(self):
+        StandIn.requests.append(dict(self.headers))
+        if self.headers.get('If-None-Match') == ETAG and self.body == FORECAST:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(self.body)))
+        if self.body == FORECAST:
+            self.send_header('ETag', ETAG)
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class YrNoTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(('127.0.0.1', 0), StandIn)
+        Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.app = load_app()
+        cls.app.FORECAST_URL = "http://127.0.0.1:%s/forecast.xml" % cls.server.server_port
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.app.CACHE_FILE = os.path.join(self.tmp.name, 'yr.no.json')
+        StandIn.body = FORECAST
+        StandIn.requests = []
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def stale(self, cache):
+        cache['fetched'] = 0
+        return cache
+
+    def test_fetch_renders_and_saves(self):
+        cache = self.app.refresh({})
+        self.assertEqual(cache['etag'], ETAG)
+        self.assertEqual(self.app.load_cache(), cache)
+
+        body = b64decode(cache['body'])
+        self.assertIn(b"24" + bytes([31]) + b"/ 0mm", body)
+        self.assertIn(b"00-06:  19" + bytes([31]) + b",  5.4km/h NNE,0.2mm", body)
+        self.assertIn(b"06-12:  23" + bytes([31]) + b", 10.8km/h   S,1.2mm", body)
+
+    def test_fresh_cache_is_not_fetched(self):
+        cache = self.app.refresh({})
+        self.assertEqual(self.app.refresh(cache), cache)
+        self.assertEqual(len(StandIn.requests), 1)
+
+    def test_not_modified_keeps_body(self):
+        cache = self.app.refresh({})
+        body = cache['body']
+
+        cache = self.app.refresh(self.stale(cache))
+        self.assertEqual(StandIn.requests[-1].get('If-None-Match'), ETAG)
+        self.assertEqual(cache['body'], body)
+        self.assertNotEqual(cache['fetched'], 0)
+        self.assertEqual(self.app.load_cache()['body'], body)
+
+    def test_empty_forecast_keeps_body(self):
+        cache = self.app.refresh({})
+        body = cache['body']
+
+        StandIn.body = b'<?xml version="1.0"?><weatherdata><forecast><tabular/></forecast></weatherdata>'
+        cache = self.app.refresh(self.stale(cache))
+        self.assertEqual(cache['body'], body)
+        self.assertEqual(self.app.load_cache()['body'], body)
+
+    def test_malformed_reply_keeps_body(self):
+        cache = self.app.refresh({})
+        body = cache['body']
+
+        for reply in (b'<html><body><h1>502 Bad Gateway</h1><hr></body>', FORECAST[:len(FORECAST) // 2]):
+            StandIn.body = reply
+            cache = self.app.refresh(self.stale(cache))
+            self.assertEqual(cache['body'], body)
+            self.assertEqual(self.app.load_cache()['body'], body)
+
+    def test_one_time_entry(self):
+        start = FORECAST.index(b'<time ', FORECAST.index(b'</time>'))
+        StandIn.body = FORECAST[:start] + FORECAST[FORECAST.index(b'</tabular>'):]
+        cache = self.app.refresh({})
+        self.assertIn(b"24" + bytes([31]), b64decode(cache['body']))
+
+
+if __name__ == '__main__':
+    unittest.main()